@@ -0,0 +1,175 @@
+"""repybodies.py - Times how the repy HTTP code copies large bodies.
+
+Runs httpretrieve's body reading and sending, and httpserver's sending, over
+fake in-memory sockets with 1, 10 and 50 MB bodies, next to the old
+implementations (string += on every read, re-slicing after every send) they
+replaced. It also checks that chunked bodies decode correctly however the
+network splits them up.
+
+The repy sources are exec'd with just enough of the repy API stubbed in to
+load them, so this runs under plain Python 2 from the repository root:
+
+  python benchmarks/repybodies.py [size in MB ...]
+
+"""
+import os
+import random
+import sys
+import threading
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# How much data the fake sockets move per call, roughly what a real socket
+# hands back on a busy connection.
+RECV_SIZE = 16 * 1024
+SEND_SIZE = 64 * 1024
+
+
+class FakeSocket:
+  # Serves body from recv() and swallows everything given to send().
+
+  def __init__(self, body=""):
+    self.body = body
+    self.offset = 0
+    self.sent = 0
+
+  def recv(self, size):
+    if self.offset >= len(self.body):
+      raise Exception("Socket closed")
+    data = self.body[self.offset:self.offset + min(size, RECV_SIZE)]
+    self.offset += len(data)
+    return data
+
+  def send(self, data):
+    sent = min(len(data), SEND_SIZE)
+    self.sent += sent
+    return sent
+
+  def settimeout(self, timeout):
+    pass
+
+  def close(self):
+    pass
+
+
+class SegmentedSocket(FakeSocket):
+  # Serves body in segments of random length, the way TCP might deliver it,
+  # so that chunk size lines and CRLFs are split across reads.
+
+  def recv(self, size):
+    if self.offset >= len(self.body):
+      raise Exception("Socket closed")
+    data = self.body[self.offset:self.offset + min(size, random.randint(1, 1500))]
+    self.offset += len(data)
+    return data
+
+
+def loadRepy(*names):
+  # exec the repy files into one namespace, the way the repy preprocessor
+  # would inline them.
+  namespace = {'getlock' : threading.Lock, 'getruntime' : time.time, 'sleep' : time.sleep, 'mycontext' : {}, \
+    'callfunc' : 'import'}
+  for name in names:
+    lines = open(os.path.join(REPO, name)).read().split("\n")
+    source = "\n".join([line for line in lines if not line.startswith("include ")])
+    exec compile(source, name, 'exec') in namespace
+  return namespace
+
+
+# The implementations before the switch to joins and offsets.
+def oldRead(sock):
+  content = ''
+  while True:
+    try:
+      chunk = sock.recv(4096)
+    except Exception, e:
+      if str(e) == "Socket closed":
+        break
+      raise
+    content += chunk
+    if chunk == "":
+      break
+  return content
+
+
+def oldSendall(sock, data):
+  while len(data) > 0:
+    data = data[sock.send(data):]
+
+
+def chunkedBody(body):
+  # Encode body with chunks of random sizes.
+  chunks = []
+  offset = 0
+  while offset < len(body):
+    size = random.randint(1, 5000)
+    chunks.append("%x\r\n%s\r\n" % (len(body[offset:offset + size]), body[offset:offset + size]))
+    offset += size
+  return "".join(chunks) + "0\r\n\r\n"
+
+
+# Decode a chunked body through httpretrieve, starting with rawdata already read from the socket along with the
+# headers, and make sure it comes back whole. A hang here means _readline isn't reading more from the socket.
+def checkChunked(repy, body, rawdata, rest):
+  filelike = repy['_httpretrieve_filelikeobject'](SegmentedSocket(rest), {}, ("HTTP/1.1", 200, "OK"), chunked=True, \
+    rawdata=rawdata)
+  assert filelike.read() == body
+
+
+def timeIt(function):
+  start = time.time()
+  function()
+  return time.time() - start
+
+
+def main():
+  sizes = [int(arg) for arg in sys.argv[1:]] or [1, 10, 50]
+  repy = loadRepy('urlparse.repy', 'urllib.repy', 'httpretrieve.repy', 'httpserver.repy')
+
+  def newRead(sock):
+    return repy['_httpretrieve_filelikeobject'](sock, {}, ("HTTP/1.0", 200, "OK")).read()
+
+  print "%6s  %-28s %10s %10s %8s" % ("MB", "path", "old (s)", "new (s)", "speedup")
+  for size in sizes:
+    body = "x" * (size * 1024 * 1024)
+    cases = [
+      ("httpretrieve read()", lambda: oldRead(FakeSocket(body)), lambda: newRead(FakeSocket(body))),
+      ("_httpretrieve_sendall", lambda: oldSendall(FakeSocket(), body), \
+        lambda: repy['_httpretrieve_sendall'](FakeSocket(), body)),
+      ("_httpserver_sendAll", lambda: oldSendall(FakeSocket(), body), \
+        lambda: repy['_httpserver_sendAll'](FakeSocket(), body)),
+    ]
+    for name, old, new in cases:
+      oldTime = timeIt(old)
+      newTime = timeIt(new)
+      print "%6d  %-28s %10.3f %10.3f %7.1fx" % (size, name, oldTime, newTime, oldTime / max(newTime, 1e-6))
+
+  # Make sure the new read gives back the body it was given.
+  assert newRead(FakeSocket(body)) == body
+
+  # Chunked bodies, split at random, and with the headers leaving part of a chunk size line or a CRLF behind.
+  for i in range(20):
+    body = "".join([chr(random.randint(0, 255)) for j in range(50 * 1024)])
+    encoded = chunkedBody(body)
+    split = random.randint(0, 20)
+    checkChunked(repy, body, encoded[:split], encoded[split:])
+  checkChunked(repy, "0123456789", "a", "\r\n0123456789\r\n0\r\n\r\n")
+  checkChunked(repy, "0123456789", "a\r", "\n0123456789\r\n0\r\n\r\n")
+  checkChunked(repy, "0123456789", "a\r\n0123456789\r", "\n0\r\n\r\n")
+  print "Chunked decoding: ok"
+
+  # A body cut short of its Content-Length is an error, not the end of the body.
+  filelike = repy['_httpretrieve_filelikeobject'](SegmentedSocket("x" * 500), {}, ("HTTP/1.1", 200, "OK"), \
+    bodylength=1000)
+  try:
+    filelike.read()
+  except repy['HttpConnectionError']:
+    pass
+  else:
+    raise AssertionError("Truncated body wasn't reported")
+  print "Truncated bodies: ok"
+
+
+if __name__ == '__main__':
+  main()
@@ -104,8 +104,11 @@
     docstring.
 """
 
+import collections
 import os
+import Queue
 import random
+import threading
 import time
 import traceback
 import xmlrpclib
@@ -123,7 +126,6 @@ import repyimporter
 import fastnmclient
 repytime = repyimporter.import_repy_module("time")
 rsa = repyimporter.import_repy_module("rsa")
-parallelize = repyimporter.import_repy_module("parallelize")
 advertise = repyimporter.import_repy_module("advertise")
 
 # The maximum number of node locations to return from a call to lookup_node_locations.
@@ -136,6 +138,21 @@ defaulttimeout = 10
 # The number of worker threads to use for each parallelized operation.
 num_worker_threads = 5
 
+# The most node manager handles to keep, how long, in seconds, a handle may
+# go unused before it is dropped, and how long one may sit idle before we
+# check in the background that its node still answers.
+nmhandle_cache_max_size = 256
+nmhandle_cache_idle_ttl = 30 * 60
+nmhandle_cache_revalidate_interval = 5 * 60
+
+# The file node locations are kept in between runs, or None to only keep them
+# in memory. Relative paths are relative to the current directory.
+node_location_cache_filename = "nodelocations.cache"
+
+# How long, in seconds, a node location is trusted before the node is looked
+# up again.
+node_location_cache_ttl = 24 * 60 * 60
+
 # Whether additional information and debugging messages should be printed
 # to stderr by this library.
 print_debug_messages = True
@@ -201,13 +218,31 @@ VESSEL_STATUS_SET_INACTIVE = set([VESSEL_STATUS_NO_SUCH_NODE, VESSEL_STATUS_NO_S
 # Whether _initialize_time() has been called.
 _initialize_time_called = False
 
-# Keys are node locations (a string of "host:port"), values are nmhandles.
-# Note that this method of caching nmhandles will cause problems if multiple
-# identities/keys are being used to contact the name node.
-_nmhandle_cache = {}
-
-# Keys are nodeids, values are nodelocations.
+# Keys are (identity's public key string or "None", nodelocation) tuples,
+# values are dicts with the keys 'nmhandle', 'lastused' and 'lastchecked'
+# (the last time the node was known to answer). Kept in least recently used
+# order and guarded by _nmhandle_cache_lock. See _get_nmhandle().
+_nmhandle_cache = collections.OrderedDict()
+_nmhandle_cache_lock = threading.Lock()
+_nmhandle_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0,
+                         'revalidations': 0}
+_nmhandle_revalidation_thread = None
+
+# Handles dropped from _nmhandle_cache can still be in use by other threads,
+# so they are only destroyed once the last of them is done. Keys are
+# nmhandles handed out by _get_nmhandle and not yet passed back to
+# _release_nmhandle, values are how many callers have them. Handles dropped
+# while in use wait in _nmhandle_retired. Both are guarded by
+# _nmhandle_cache_lock.
+_nmhandle_users = {}
+_nmhandle_retired = set()
+
+# Keys are nodeids, values are (nodelocation, time it was learned) tuples.
+# Read from node_location_cache_filename the first time it is used; see
+# _load_node_location_cache(). Guarded by _node_location_cache_lock.
 _node_location_cache = {}
+_node_location_cache_loaded = False
+_node_location_cache_lock = threading.Lock()
 
 
 
@@ -400,46 +435,274 @@ def _get_nmhandle(nodelocation, identity=None):
   """
   Get an nmhandle for the nodelocation and identity, if provided. This will look
   use a cache of nmhandles and only create a new one if the requested nmhandle
-  has not previously been requested.
+  has not previously been requested, or has since been dropped from the cache.
+  Every handle returned must be passed to _release_nmhandle once the caller
+  is done with it.
   """
-  
+
   # Call _initialize_time() here because time must be updated at least once before
   # nmhandles are used.
   _initialize_time()
-  
+
   host, port = nodelocation.split(':')
   port = int(port)
-  
-  if identity is None:
-    identitystring = "None"
+
+  cachekey = (_nmhandle_identitystring(identity), nodelocation)
+
+  _nmhandle_cache_lock.acquire()
+  try:
+    _expire_nmhandles()
+    if cachekey in _nmhandle_cache:
+      # Move the entry to the most recently used end.
+      entry = _nmhandle_cache.pop(cachekey)
+      entry['lastused'] = time.time()
+      _nmhandle_cache[cachekey] = entry
+      _nmhandle_cache_stats['hits'] += 1
+      _nmhandle_users[entry['nmhandle']] = _nmhandle_users.get(entry['nmhandle'], 0) + 1
+      return entry['nmhandle']
+    _nmhandle_cache_stats['misses'] += 1
+  finally:
+    _nmhandle_cache_lock.release()
+
+  try:
+    if identity is None:
+      nmhandle = fastnmclient.nmclient_createhandle(host, port, timeout=defaulttimeout)
+    elif 'privatekey_dict' in identity:
+      nmhandle = fastnmclient.nmclient_createhandle(host, port, privatekey=identity['privatekey_dict'],
+                                         publickey=identity['publickey_dict'], timeout=defaulttimeout)
+    else:
+      nmhandle = fastnmclient.nmclient_createhandle(host, port, publickey=identity['publickey_dict'],
+                                                timeout=defaulttimeout)
+  except fastnmclient.NMClientException, e:
+    raise NodeCommunicationError(str(e))
+
+  return _cache_nmhandle(nodelocation, identity, nmhandle, inuse=True)
+
+
+
+
+
+def _cache_nmhandle(nodelocation, identity, nmhandle, inuse=False):
+  """
+  Keeps an nmhandle for _get_nmhandle to hand out, evicting the least recently
+  used handles if the cache is full. If another thread cached a handle for the
+  same nodelocation and identity in the meantime, the new handle is destroyed
+  and the cached one returned instead. If inuse is True, the returned handle
+  is counted as in use, and must be passed to _release_nmhandle.
+  """
+  cachekey = (_nmhandle_identitystring(identity), nodelocation)
+  now = time.time()
+
+  _nmhandle_cache_lock.acquire()
+  try:
+    if cachekey in _nmhandle_cache:
+      # Nobody else has seen the new handle yet, so it can go right away.
+      fastnmclient.nmclient_destroyhandle(nmhandle)
+      nmhandle = _nmhandle_cache[cachekey]['nmhandle']
+    else:
+      _nmhandle_cache[cachekey] = {'nmhandle': nmhandle, 'lastused': now, 'lastchecked': now}
+      while len(_nmhandle_cache) > nmhandle_cache_max_size:
+        oldkey, oldentry = _nmhandle_cache.popitem(last=False)
+        _retire_nmhandle(oldentry['nmhandle'])
+        _nmhandle_cache_stats['evictions'] += 1
+      _start_nmhandle_revalidation()
+
+    if inuse:
+      _nmhandle_users[nmhandle] = _nmhandle_users.get(nmhandle, 0) + 1
+    return nmhandle
+  finally:
+    _nmhandle_cache_lock.release()
+
+
+
+
+
+def _release_nmhandle(nmhandle):
+  """
+  Called by users of _get_nmhandle when they're done with the handle. The
+  handle is destroyed if it has been dropped from the cache and nobody else
+  is using it.
+  """
+  _nmhandle_cache_lock.acquire()
+  try:
+    _nmhandle_users[nmhandle] -= 1
+    if _nmhandle_users[nmhandle] == 0:
+      del _nmhandle_users[nmhandle]
+      if nmhandle in _nmhandle_retired:
+        _nmhandle_retired.remove(nmhandle)
+        fastnmclient.nmclient_destroyhandle(nmhandle)
+  finally:
+    _nmhandle_cache_lock.release()
+
+
+
+
+
+def _retire_nmhandle(nmhandle):
+  """
+  Destroys a handle that has been dropped from the cache, or, if another
+  thread is using it, leaves that to the last _release_nmhandle. Call with
+  _nmhandle_cache_lock held.
+  """
+  if nmhandle in _nmhandle_users:
+    _nmhandle_retired.add(nmhandle)
   else:
-    identitystring = identity['publickey_str']
-    
-  if identitystring not in _nmhandle_cache:
-    _nmhandle_cache[identitystring] = {}
+    fastnmclient.nmclient_destroyhandle(nmhandle)
+
+
+
+
+
+def _nmhandle_identitystring(identity):
+  if identity is None:
+    return "None"
+  return identity['publickey_str']
+
+
+
+
+
+def _expire_nmhandles():
+  """
+  Drops handles that haven't been used for nmhandle_cache_idle_ttl seconds.
+  Call with _nmhandle_cache_lock held.
+  """
+  now = time.time()
+  # The cache is in least recently used order, so stop at the first handle
+  # that's still in use.
+  for cachekey, entry in _nmhandle_cache.items():
+    if now - entry['lastused'] < nmhandle_cache_idle_ttl:
+      break
+    del _nmhandle_cache[cachekey]
+    _retire_nmhandle(entry['nmhandle'])
+    _nmhandle_cache_stats['evictions'] += 1
+
+
+
+
+
+def _invalidate_nmhandles(nodelocation):
+  """
+  Drops the handles for a nodelocation, for every identity, so that the next
+  request makes a fresh one. Called when communication with the node fails.
+  """
+  _nmhandle_cache_lock.acquire()
+  try:
+    for cachekey in _nmhandle_cache.keys():
+      if cachekey[1] == nodelocation:
+        entry = _nmhandle_cache.pop(cachekey)
+        _retire_nmhandle(entry['nmhandle'])
+        _nmhandle_cache_stats['invalidations'] += 1
+  finally:
+    _nmhandle_cache_lock.release()
+
+
+
+
+
+def _start_nmhandle_revalidation():
+  """
+  Starts the thread that revalidates idle handles, if it isn't running yet.
+  Call with _nmhandle_cache_lock held.
+  """
+  global _nmhandle_revalidation_thread
+  if _nmhandle_revalidation_thread is None:
+    _nmhandle_revalidation_thread = threading.Thread(target=_revalidate_nmhandles)
+    _nmhandle_revalidation_thread.daemon = True
+    _nmhandle_revalidation_thread.start()
+
 
-  if nodelocation not in _nmhandle_cache[identitystring]:
+
+
+
+def _revalidate_nmhandles():
+  """
+  Runs in the background. Every nmhandle_cache_revalidate_interval seconds,
+  checks that the nodes behind handles that have sat idle that long still
+  answer, and drops the handles of those that don't, so that requests don't
+  wait on dead handles.
+  """
+  while True:
+    time.sleep(nmhandle_cache_revalidate_interval)
+
+    now = time.time()
+    _nmhandle_cache_lock.acquire()
     try:
-      if identity is None:
-        nmhandle = fastnmclient.nmclient_createhandle(host, port, timeout=defaulttimeout)
-      elif 'privatekey_dict' in identity:
-        nmhandle = fastnmclient.nmclient_createhandle(host, port, privatekey=identity['privatekey_dict'],
-                                           publickey=identity['publickey_dict'], timeout=defaulttimeout)
-      else:
-        nmhandle = fastnmclient.nmclient_createhandle(host, port, publickey=identity['publickey_dict'],
-                                                  timeout=defaulttimeout)
-    except fastnmclient.NMClientException, e:
-      raise NodeCommunicationError(str(e))
-    
-    _nmhandle_cache[identitystring][nodelocation] = nmhandle
-    
-  return _nmhandle_cache[identitystring][nodelocation]
+      _expire_nmhandles()
+      idlelist = []
+      for cachekey, entry in _nmhandle_cache.items():
+        if now - max(entry['lastused'], entry['lastchecked']) >= nmhandle_cache_revalidate_interval:
+          idlelist.append((cachekey, entry))
+          # We use the handle outside the lock, like any other caller.
+          _nmhandle_users[entry['nmhandle']] = _nmhandle_users.get(entry['nmhandle'], 0) + 1
+    finally:
+      _nmhandle_cache_lock.release()
+
+    for cachekey, entry in idlelist:
+      try:
+        fastnmclient.nmclient_rawsay(entry['nmhandle'], "GetVessels")
+        alive = True
+      except fastnmclient.NMClientException, e:
+        alive = False
 
+      _nmhandle_cache_lock.acquire()
+      try:
+        _nmhandle_cache_stats['revalidations'] += 1
+        # Leave it be if it was dropped or replaced while we were checking.
+        if _nmhandle_cache.get(cachekey) is entry:
+          if alive:
+            entry['lastchecked'] = time.time()
+          else:
+            del _nmhandle_cache[cachekey]
+            _retire_nmhandle(entry['nmhandle'])
+            _nmhandle_cache_stats['invalidations'] += 1
+      finally:
+        _nmhandle_cache_lock.release()
+      _release_nmhandle(entry['nmhandle'])
 
 
 
 
-def run_parallelized(targetlist, func, *args):
+
+def get_nmhandle_cache_stats():
+  """
+  <Purpose>
+    Report how well the cache of node manager handles is doing.
+  <Arguments>
+    None
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Returns>
+    A dictionary with the keys:
+      'size'
+        The number of handles cached now.
+      'hits', 'misses'
+        How many requests for a handle were answered from the cache, and how
+        many had to create a new one.
+      'evictions'
+        How many handles were dropped for being unused too long or to make
+        room for others.
+      'invalidations'
+        How many handles were dropped because their node couldn't be
+        reached.
+      'revalidations'
+        How many idle handles have been checked in the background.
+  """
+  _nmhandle_cache_lock.acquire()
+  try:
+    stats = dict(_nmhandle_cache_stats)
+    stats['size'] = len(_nmhandle_cache)
+    return stats
+  finally:
+    _nmhandle_cache_lock.release()
+
+
+
+
+
+def run_parallelized(targetlist, func, *args, **kwargs):
   """
   <Purpose>
     Parallelize the calling of a given function using multiple threads.
@@ -452,6 +715,13 @@ def run_parallelized(targetlist, func, *args):
       (optional) every additional argument will be passed to func after an
       item from targetlist. That is, these will be the second, third, etc.
       argument to func, if provided. These are not required a.
+    num_threads
+      (optional, keyword only) the number of threads to call func from. If not
+      provided, num_worker_threads (a global variable) is used.
+    timeout
+      (optional, keyword only) the number of seconds to wait for all of the
+      calls to func to finish. Targets whose call hasn't finished by then are
+      reported as failed. If not provided, this waits for as long as it takes.
   <Exceptions>
     SeattleExperimentError
       Raised if there is a problem performing parallel processing. This will
@@ -459,8 +729,10 @@ def run_parallelized(targetlist, func, *args):
       exceptions when it is called, that exception information will be
       available through the run_parallelized's return value.
   <Side Effects>
-    Up to num_worker_threads (a global variable) threads will be spawned to
-    call func once for every item in targetlist.
+    Up to num_threads (by default num_worker_threads, a global variable)
+    threads will be spawned to call func once for every item in targetlist.
+    Calls still running when the timeout expires are left to finish in the
+    background.
   <Returns>
     A tuple of:
       (successlist, failurelist)
@@ -471,28 +743,126 @@ def run_parallelized(targetlist, func, *args):
     Note that exception_string will not contain a full traceback, but rather
     only the string representation of the exception.
   """
-  
+  successlist = []
+  failurelist = []
+
+  for (target, retval, error) in run_parallelized_as_completed(targetlist, func, *args, **kwargs):
+    if error is None:
+      successlist.append((target, retval))
+    else:
+      failurelist.append((target, error))
+
+  return successlist, failurelist
+
+
+
+
+
+def run_parallelized_as_completed(targetlist, func, *args, **kwargs):
+  """
+  <Purpose>
+    Like run_parallelized, but hands back the result of each call to func as
+    soon as that call finishes, so that the caller can act on the first
+    results while the rest are still running.
+  <Arguments>
+    The same as run_parallelized, including the num_threads and timeout
+    keyword arguments.
+  <Exceptions>
+    SeattleExperimentError
+      Raised if there is a problem starting the threads. As with
+      run_parallelized, exceptions raised by func are not raised here.
+  <Side Effects>
+    The same as run_parallelized. If the caller stops iterating early, no
+    further calls to func are started.
+  <Returns>
+    A generator that yields one tuple per item in targetlist, in the order the
+    calls finish, of the format:
+      (target, return_value_from_func, None)
+    if func returned, or
+      (target, None, exception_string)
+    if func raised an exception or didn't finish before the timeout.
+  """
+  num_threads = kwargs.pop('num_threads', num_worker_threads)
+  timeout = kwargs.pop('timeout', None)
+  if kwargs:
+    raise TypeError("run_parallelized() got unexpected keyword arguments: " +
+                    ", ".join(kwargs.keys()))
+
+  # Targets are numbered so that duplicates in targetlist are each accounted
+  # for once.
+  targetqueue = Queue.Queue()
+  pending = {}
+  for index, target in enumerate(targetlist):
+    targetqueue.put((index, target))
+    pending[index] = target
+
+  resultqueue = Queue.Queue()
+  stopevent = threading.Event()
+
   try:
-    phandle = parallelize.parallelize_initfunction(targetlist, func, num_worker_threads, *args)
-  
-    while not parallelize.parallelize_isfunctionfinished(phandle):
-      # TODO: Give up after a timeout? This seems risky as run_parallelized may
-      # be used with functions that take a long time to complete and very large
-      # lists of targets. It would be a shame to break a user's program because
-      # of an assumption here. Maybe it should be an optional argument to 
-      # run_parallelized.
-      time.sleep(.1)
-    
-    results = parallelize.parallelize_getresults(phandle)
-  except parallelize.ParallelizeError:
+    for i in range(min(num_threads, len(pending))):
+      worker = threading.Thread(target=_run_parallelized_worker,
+                                args=(targetqueue, resultqueue, stopevent, func, args))
+      worker.daemon = True
+      worker.start()
+  except threading.ThreadError:
+    stopevent.set()
     raise SeattleExperimentError("Error occurred in run_parallelized: " + 
                                  traceback.format_exc())
+
+  return _run_parallelized_results(resultqueue, stopevent, pending, timeout)
+
+
+
+
+
+def _run_parallelized_results(resultqueue, stopevent, pending, timeout):
+  """
+  The generator returned by run_parallelized_as_completed. Kept separate so
+  that the threads are started, and bad arguments are reported, when
+  run_parallelized_as_completed is called rather than on the first next().
+  """
+  if timeout is not None:
+    deadline = time.time() + timeout
+
+  try:
+    while pending:
+      # Workers hand each result over as they finish, so we wake up as soon
+      # as there is something to yield rather than polling.
+      try:
+        if timeout is None:
+          index, target, retval, error = resultqueue.get()
+        else:
+          index, target, retval, error = resultqueue.get(True, max(0, deadline - time.time()))
+      except Queue.Empty:
+        break
+      del pending[index]
+      yield (target, retval, error)
+
+    # Whatever is left didn't finish in time.
+    stopevent.set()
+    for index in sorted(pending.keys()):
+      yield (pending[index], None, "Timed out after " + str(timeout) + " seconds")
   finally:
-    parallelize.parallelize_closefunction(phandle)
+    # Also reached if the caller stops iterating early.
+    stopevent.set()
+
+
 
-  # These are lists of tuples. The first is a list of (target, retval), the
-  # second is a list of (target, errormsg)
-  return results['returned'], results['exception']
+
+
+def _run_parallelized_worker(targetqueue, resultqueue, stopevent, func, args):
+  while not stopevent.isSet():
+    try:
+      index, target = targetqueue.get_nowait()
+    except Queue.Empty:
+      return
+    try:
+      retval = func(target, *args)
+    except Exception, e:
+      resultqueue.put((index, target, None, str(e)))
+    else:
+      resultqueue.put((index, target, retval, None))
 
     
   
@@ -725,7 +1095,10 @@ def browse_node(nodelocation, identity=None):
     try:
       nodeinfo = fastnmclient.nmclient_getvesseldict(nmhandle)
     except fastnmclient.NMClientException, e:
+      _invalidate_nmhandles(nodelocation)
       raise NodeCommunicationError("Failed to communicate with node " + nodelocation + ": " + str(e))
+    finally:
+      _release_nmhandle(nmhandle)
   
     # We do our own looking through the nodeinfo rather than use the function
     # nmclient_listaccessiblevessels() as we don't want to contact the node a
@@ -744,7 +1117,7 @@ def browse_node(nodelocation, identity=None):
     # For efficiency, let's update the _node_location_cache with this info.
     # This can prevent individual advertise lookups of each nodeid by other
     # functions in the experimentlib that may be called later.
-    _node_location_cache[nodeid] = nodelocation
+    _cache_node_location(nodeid, nodelocation)
 
     vesseldict_list = []
     for vesselname in usablevessels:
@@ -793,28 +1166,10 @@ def get_vessel_status(vesselhandle, identity):
   _validate_vesselhandle(vesselhandle)
   _validate_identity(identity)
     
-  # Determine the last known location of the node. 
   nodeid, vesselname = vesselhandle.split(":")
-  try:
-    # This will get a cached node location if one exists.
-    nodelocation = get_node_location(nodeid)
-  except NodeLocationNotAdvertisedError, e:
-    return VESSEL_STATUS_NO_SUCH_NODE
-  
-  try:
-    vesselinfolist = browse_node(nodelocation, identity)
-  except NodeCommunicationError:
-    # Do a non-cache lookup of the nodeid to see if the node moved.
-    try:
-      nodelocation = get_node_location(nodeid, ignorecache=True)
-    except NodeLocationNotAdvertisedError, e:
-      return VESSEL_STATUS_NO_SUCH_NODE
-
-    # Try to communicate again.
-    try:
-      vesselinfolist = browse_node(nodelocation, identity)
-    except NodeCommunicationError, e:
-      return VESSEL_STATUS_NODE_UNREACHABLE
+  vesselinfolist, nodestatus = _browse_node_by_nodeid(nodeid, identity)
+  if vesselinfolist is None:
+    return nodestatus
 
   for vesselinfo in vesselinfolist:
     if vesselinfo['vesselhandle'] == vesselhandle:
@@ -830,6 +1185,118 @@ def get_vessel_status(vesselhandle, identity):
   else:
     # The node is up but this vessel doesn't exist.
     return VESSEL_STATUS_NO_SUCH_VESSEL
+
+
+
+
+
+def get_vessel_statuses(vesselhandle_list, identity):
+  """
+  <Purpose>
+    Determine the status of a number of vessels at once. Each node is
+    contacted only once, however many of the vessels are on it, and the nodes
+    are contacted in parallel.
+  <Arguments>
+    vesselhandle_list
+      The vesselhandles of the vessels whose status is to be checked.
+    identity
+      The identity of the owner or a user of the vessels.
+  <Exceptions>
+    SeattleExperimentError
+      Raised if there is a problem performing parallel processing.
+  <Side Effects>
+    The nodes the vessels are on are communicated with.
+  <Returns>
+    A dictionary mapping each vesselhandle to a string that is one of the
+    VESSEL_STATUS_* constants. Unlike get_vessel_status, a status the node
+    reports that this experimentlib doesn't expect is returned as is rather
+    than raised, so that one odd vessel doesn't hide the status of the rest.
+    Vessels on a node that couldn't be checked for any other reason are
+    given VESSEL_STATUS_NODE_UNREACHABLE.
+  """
+  _validate_vesselhandle_list(vesselhandle_list)
+  _validate_identity(identity)
+
+  # Group the vessels by the node they're on.
+  vesselhandles_by_nodeid = {}
+  for vesselhandle in vesselhandle_list:
+    nodeid, vesselname = vesselhandle.split(":")
+    vesselhandles_by_nodeid.setdefault(nodeid, []).append(vesselhandle)
+
+  successlist, failurelist = run_parallelized(vesselhandles_by_nodeid.keys(),
+                                              _get_vessel_statuses_on_node,
+                                              vesselhandles_by_nodeid, identity)
+
+  statusdict = {}
+  for nodeid, nodestatusdict in successlist:
+    statusdict.update(nodestatusdict)
+  for nodeid, errorstring in failurelist:
+    for vesselhandle in vesselhandles_by_nodeid[nodeid]:
+      statusdict[vesselhandle] = VESSEL_STATUS_NODE_UNREACHABLE
+  return statusdict
+
+
+
+
+
+def _get_vessel_statuses_on_node(nodeid, vesselhandles_by_nodeid, identity):
+  """
+  Returns a dictionary mapping the vesselhandles in vesselhandles_by_nodeid
+  that are on the node nodeid to their status, from a single browse of the
+  node. Called through run_parallelized by get_vessel_statuses.
+  """
+  vesselinfolist, nodestatus = _browse_node_by_nodeid(nodeid, identity)
+
+  statusdict = {}
+  for vesselhandle in vesselhandles_by_nodeid[nodeid]:
+    if vesselinfolist is None:
+      statusdict[vesselhandle] = nodestatus
+    else:
+      statusdict[vesselhandle] = VESSEL_STATUS_NO_SUCH_VESSEL
+
+  if vesselinfolist is not None:
+    for vesselinfo in vesselinfolist:
+      if vesselinfo['vesselhandle'] in statusdict:
+        statusdict[vesselinfo['vesselhandle']] = vesselinfo['status']
+
+  return statusdict
+
+
+
+
+
+def _browse_node_by_nodeid(nodeid, identity):
+  """
+  Browses the node with the given nodeid, looking its location up again if
+  it can't be reached at the last known one. Returns a tuple of:
+    (vesselinfolist, None)
+  with the result of browse_node if the node could be browsed, or else:
+    (None, nodestatus)
+  where nodestatus is VESSEL_STATUS_NO_SUCH_NODE or
+  VESSEL_STATUS_NODE_UNREACHABLE.
+  """
+  # Determine the last known location of the node. 
+  try:
+    # This will get a cached node location if one exists.
+    nodelocation = get_node_location(nodeid)
+  except NodeLocationNotAdvertisedError, e:
+    return None, VESSEL_STATUS_NO_SUCH_NODE
+  
+  try:
+    return browse_node(nodelocation, identity), None
+  except NodeCommunicationError:
+    # Do a non-cache lookup of the nodeid to see if the node moved.
+    _invalidate_node_location(nodeid)
+    try:
+      nodelocation = get_node_location(nodeid, ignorecache=True)
+    except NodeLocationNotAdvertisedError, e:
+      return None, VESSEL_STATUS_NO_SUCH_NODE
+
+    # Try to communicate again.
+    try:
+      return browse_node(nodelocation, identity), None
+    except NodeCommunicationError, e:
+      return None, VESSEL_STATUS_NODE_UNREACHABLE
       
 
 
@@ -837,12 +1304,21 @@ def get_vessel_status(vesselhandle, identity):
 
 def _do_public_node_request(nodeid, requestname, *args):
   nodelocation = get_node_location(nodeid)
-  nmhandle = _get_nmhandle(nodelocation)
   
   try:
-    return fastnmclient.nmclient_rawsay(nmhandle, requestname, *args)
+    nmhandle = _get_nmhandle(nodelocation)
+    try:
+      return fastnmclient.nmclient_rawsay(nmhandle, requestname, *args)
+    finally:
+      _release_nmhandle(nmhandle)
   except fastnmclient.NMClientException, e:
+    _invalidate_node_location(nodeid)
+    _invalidate_nmhandles(nodelocation)
     raise NodeCommunicationError(str(e))
+  except NodeCommunicationError:
+    _invalidate_node_location(nodeid)
+    _invalidate_nmhandles(nodelocation)
+    raise
 
 
 
@@ -853,12 +1329,21 @@ def _do_signed_vessel_request(identity, vesselhandle, requestname, *args):
   
   nodeid, vesselname = vesselhandle.split(':')
   nodelocation = get_node_location(nodeid)
-  nmhandle = _get_nmhandle(nodelocation, identity)
   
   try:
-    return fastnmclient.nmclient_signedsay(nmhandle, requestname, vesselname, *args)
+    nmhandle = _get_nmhandle(nodelocation, identity)
+    try:
+      return fastnmclient.nmclient_signedsay(nmhandle, requestname, vesselname, *args)
+    finally:
+      _release_nmhandle(nmhandle)
   except fastnmclient.NMClientException, e:
+    _invalidate_node_location(nodeid)
+    _invalidate_nmhandles(nodelocation)
     raise NodeCommunicationError(str(e))
+  except NodeCommunicationError:
+    _invalidate_node_location(nodeid)
+    _invalidate_nmhandles(nodelocation)
+    raise
 
 
 
@@ -1510,34 +1995,266 @@ def get_node_location(nodeid, ignorecache=False):
     with and is instead only the most likely location of a node at the time
     this function was called.
   """
-  if ignorecache or nodeid not in _node_location_cache:
-    locationlist = lookup_node_locations_by_nodeid(nodeid)
-    if not locationlist:
-      raise NodeLocationLookupError("Nothing advertised under node's key.")
-    # If there is more than one advertised location, we need to figure out
-    # which one is valid. For example, if a node moves then there will be
-    # a period of time in which the old advertised location and the new
-    # one are both returned. We need to determine the correct one.
-    elif len(locationlist) > 1:
-      for possiblelocation in locationlist:
-        host, portstr = possiblelocation.split(':')
-        try:
-          # We create an nmhandle directly because we want to use it to test
-          # basic communication, which is done when an nmhandle is created.
-          nmhandle = fastnmclient.nmclient_createhandle(host, int(portstr))
-        except fastnmclient.NMClientException, e:
-          continue
-        else:
-          fastnmclient.nmclient_destroyhandle(nmhandle)
-          _node_location_cache[nodeid] = possiblelocation
-          break
-      else:
-        raise NodeCommunicationError("Multiple node locations advertised but none " + 
-                                     "can be communicated with: " + str(locationlist))
+  if not ignorecache:
+    nodelocation = _get_cached_node_location(nodeid)
+    if nodelocation is not None:
+      return nodelocation
+
+  locationlist = lookup_node_locations_by_nodeid(nodeid)
+  if not locationlist:
+    raise NodeLocationLookupError("Nothing advertised under node's key.")
+  # If there is more than one advertised location, we need to figure out
+  # which one is valid. For example, if a node moves then there will be
+  # a period of time in which the old advertised location and the new
+  # one are both returned. We need to determine the correct one.
+  elif len(locationlist) > 1:
+    nodelocation = _probe_node_locations(locationlist)
+    if nodelocation is None:
+      raise NodeCommunicationError("Multiple node locations advertised but none " + 
+                                   "can be communicated with: " + str(locationlist))
+  else:
+    nodelocation = locationlist[0]
+
+  _cache_node_location(nodeid, nodelocation)
+  return nodelocation
+
+
+
+
+
+def _probe_node_locations(locationlist):
+  """
+  Tries to communicate with each of the nodelocations in locationlist at
+  once, and returns the first one that answers, or None if none of them do
+  within a few seconds more than defaulttimeout. The probes are made without
+  an identity, so the winner's nmhandle goes into _nmhandle_cache as the
+  public handle for that location: a public request that follows (see
+  _do_public_node_request, or browse_node without an identity) reuses it,
+  but signed requests and those made with an identity still create their
+  own. Attempts still under way once there is a winner are left to finish
+  in the background, and their handles are destroyed.
+  """
+  # Call _initialize_time() here because time must be updated at least once before
+  # nmhandles are used.
+  _initialize_time()
+
+  resultqueue = Queue.Queue()
+  probestate = {'winner': None}
+  probelock = threading.Lock()
+
+  def probe(possiblelocation):
+    try:
+      host, portstr = possiblelocation.split(':')
+      # We create an nmhandle directly because we want to use it to test
+      # basic communication, which is done when an nmhandle is created.
+      nmhandle = fastnmclient.nmclient_createhandle(host, int(portstr), timeout=defaulttimeout)
+    except Exception, e:
+      # Including malformed advertised locations. Every probe has to report
+      # back, or the caller would wait on it.
+      resultqueue.put((possiblelocation, None))
+      return
+
+    probelock.acquire()
+    try:
+      won = probestate['winner'] is None
+      if won:
+        probestate['winner'] = possiblelocation
+    finally:
+      probelock.release()
+
+    if won:
+      resultqueue.put((possiblelocation, nmhandle))
     else:
-      _node_location_cache[nodeid] = locationlist[0]
-      
-  return _node_location_cache[nodeid]
+      fastnmclient.nmclient_destroyhandle(nmhandle)
+
+  for possiblelocation in locationlist:
+    probethread = threading.Thread(target=probe, args=(possiblelocation,))
+    probethread.daemon = True
+    probethread.start()
+
+  # Every probe should report a failure, or the one success, within
+  # defaulttimeout. Allow a little more than that, but don't wait forever on
+  # a probe that's stuck.
+  deadline = time.time() + defaulttimeout + 5
+  for i in range(len(locationlist)):
+    try:
+      possiblelocation, nmhandle = resultqueue.get(True, max(0, deadline - time.time()))
+    except Queue.Empty:
+      break
+    if nmhandle is not None:
+      _cache_nmhandle(possiblelocation, None, nmhandle)
+      return possiblelocation
+
+  # Make sure a probe that succeeds from now on destroys its handle, and take
+  # one that won just before we gave up.
+  probelock.acquire()
+  try:
+    if probestate['winner'] is None:
+      probestate['winner'] = ""
+  finally:
+    probelock.release()
+  while True:
+    try:
+      possiblelocation, nmhandle = resultqueue.get_nowait()
+    except Queue.Empty:
+      return None
+    if nmhandle is not None:
+      _cache_nmhandle(possiblelocation, None, nmhandle)
+      return possiblelocation
+
+
+
+
+
+def _load_node_location_cache():
+  """
+  Reads the node locations kept in node_location_cache_filename into
+  _node_location_cache, the first time it's called. Each line of the file is
+  "nodeid<TAB>nodelocation<TAB>time", and later lines supersede earlier ones;
+  an empty nodelocation means the entry was invalidated. Call with
+  _node_location_cache_lock held.
+  """
+  global _node_location_cache_loaded
+  if _node_location_cache_loaded:
+    return
+  _node_location_cache_loaded = True
+
+  if node_location_cache_filename is None:
+    return
+  try:
+    fileobj = open(node_location_cache_filename, "r")
+  except IOError:
+    return
+
+  now = time.time()
+  linecount = 0
+  try:
+    for line in fileobj:
+      fields = line.rstrip("\n").split("\t")
+      # Skip anything we can't make sense of, such as a line cut short.
+      if len(fields) != 3:
+        continue
+      nodeid, nodelocation, storedtime = fields
+      try:
+        storedtime = float(storedtime)
+      except ValueError:
+        continue
+      linecount += 1
+      if nodelocation and now - storedtime < node_location_cache_ttl:
+        _node_location_cache[nodeid] = (nodelocation, storedtime)
+      elif nodeid in _node_location_cache:
+        del _node_location_cache[nodeid]
+  finally:
+    fileobj.close()
+
+  # Once the file is mostly superseded and expired lines, start it afresh.
+  if linecount > 2 * len(_node_location_cache) + 100:
+    _rewrite_node_location_file()
+
+
+
+
+
+def _rewrite_node_location_file():
+  """
+  Replaces node_location_cache_filename with just the current contents of
+  _node_location_cache. Call with _node_location_cache_lock held.
+  """
+  tempfilename = node_location_cache_filename + ".tmp"
+  try:
+    fileobj = open(tempfilename, "w")
+    try:
+      for nodeid, (nodelocation, storedtime) in _node_location_cache.items():
+        fileobj.write("%s\t%s\t%r\n" % (nodeid, nodelocation, storedtime))
+    finally:
+      fileobj.close()
+    os.rename(tempfilename, node_location_cache_filename)
+  except (IOError, OSError):
+    # Persisting the cache is only an optimization.
+    pass
+
+
+
+
+
+def _append_node_location(nodeid, nodelocation, storedtime):
+  """
+  Records a change to _node_location_cache at the end of
+  node_location_cache_filename.
+  """
+  if node_location_cache_filename is None:
+    return
+  try:
+    fileobj = open(node_location_cache_filename, "a")
+    try:
+      fileobj.write("%s\t%s\t%r\n" % (nodeid, nodelocation, storedtime))
+    finally:
+      fileobj.close()
+  except IOError:
+    # Persisting the cache is only an optimization.
+    pass
+
+
+
+
+
+def _get_cached_node_location(nodeid):
+  """
+  Returns the cached location of the node, or None if it isn't cached or was
+  cached more than node_location_cache_ttl seconds ago.
+  """
+  _node_location_cache_lock.acquire()
+  try:
+    _load_node_location_cache()
+    if nodeid not in _node_location_cache:
+      return None
+    nodelocation, storedtime = _node_location_cache[nodeid]
+    if time.time() - storedtime >= node_location_cache_ttl:
+      del _node_location_cache[nodeid]
+      return None
+    return nodelocation
+  finally:
+    _node_location_cache_lock.release()
+
+
+
+
+
+def _cache_node_location(nodeid, nodelocation):
+  """
+  Records where a node is, in memory and on disk. Seeing a node at the
+  location we already have for it only goes to disk once the entry is half
+  way to expiring, so that frequent browsing doesn't grow the file.
+  """
+  now = time.time()
+  _node_location_cache_lock.acquire()
+  try:
+    _load_node_location_cache()
+    if nodeid in _node_location_cache:
+      oldlocation, storedtime = _node_location_cache[nodeid]
+      if oldlocation == nodelocation and now - storedtime < node_location_cache_ttl / 2:
+        return
+    _node_location_cache[nodeid] = (nodelocation, now)
+    _append_node_location(nodeid, nodelocation, now)
+  finally:
+    _node_location_cache_lock.release()
+
+
+
+
+
+def _invalidate_node_location(nodeid):
+  """
+  Forgets where a node is, for when it couldn't be reached there.
+  """
+  _node_location_cache_lock.acquire()
+  try:
+    _load_node_location_cache()
+    if nodeid in _node_location_cache:
+      del _node_location_cache[nodeid]
+      _append_node_location(nodeid, "", time.time())
+  finally:
+    _node_location_cache_lock.release()
 
 
 
@@ -1625,7 +2342,7 @@ def _seattlegeni_cache_node_locations(seattlegeni_vessel_list):
     nodeid = seattlegeni_vessel['node_id']
     ip = seattlegeni_vessel['node_ip']
     portstr = str(seattlegeni_vessel['node_port'])
-    _node_location_cache[nodeid] = ip + ':' + portstr
+    _cache_node_location(nodeid, ip + ':' + portstr)
 
 
 
@@ -0,0 +1,137 @@
+"""geoindex.py - A local, offline geoip database.
+
+The index is a file of IPv4 ranges, sorted and non-overlapping, each a fixed
+width record of (first address, last address, offset of its name). The names,
+"city<TAB>country" strings, each stored once, follow the records. The file is
+memory-mapped and searched in place, so opening it costs nothing however large
+it is and a lookup is a binary search over a few pages of it.
+
+GeoIndex.record_by_addr answers the way the geoip server's record_by_addr does,
+so either can be used to fill in vessel locations.
+
+Build an index from a CSV dump of ip ranges with:
+
+  python geoindex.py ranges.csv geoip.idx [country column] [city column]
+
+Each row of the CSV starts with the first and last address of a range, either
+dotted or as integers. By default the country name is the third column and the
+city the fourth; rows that don't parse (headers, IPv6 ranges) are skipped.
+
+"""
+import csv
+import mmap
+import os
+import socket
+import struct
+import sys
+
+MAGIC = "VPGEOIX1"
+HEADER = struct.Struct(">8sII") # magic, number of records, offset of the names
+RECORD = struct.Struct(">III") # first address, last address, offset of the name from the start of the names
+NAME_LENGTH = struct.Struct(">H")
+
+
+# An IPv4 address as an integer, from either dotted or integer form. Raises ValueError if it's neither.
+def addrToInt(addr):
+  addr = addr.strip()
+  if addr.isdigit():
+    value = int(addr)
+    if value > 0xffffffff:
+      raise ValueError("Not an IPv4 address: %s" % addr)
+    return value
+  try:
+    return struct.unpack(">I", socket.inet_aton(addr))[0]
+  except socket.error:
+    raise ValueError("Not an IPv4 address: %s" % addr)
+
+
+class GeoIndex:
+
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.count, self.namesOffset = HEADER.unpack_from(self.map, 0)
+    if magic != MAGIC:
+      self.close()
+      raise ValueError("%s isn't a geoip index" % path)
+
+  # Returns a dict with 'city' and 'country_name' keys, or None if addr isn't in any range.
+  def record_by_addr(self, addr):
+    try:
+      value = addrToInt(addr)
+    except ValueError:
+      return None
+
+    # Find the last range that starts at or before the address.
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if RECORD.unpack_from(self.map, HEADER.size + mid * RECORD.size)[0] <= value:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo == 0:
+      return None
+    first, last, nameOffset = RECORD.unpack_from(self.map, HEADER.size + (lo - 1) * RECORD.size)
+    if value > last:
+      return None
+
+    start = self.namesOffset + nameOffset
+    length = NAME_LENGTH.unpack_from(self.map, start)[0]
+    city, country = self.map[start + NAME_LENGTH.size:start + NAME_LENGTH.size + length].decode('utf-8', 'replace').split("\t")
+    return {'city' : city, 'country_name' : country}
+
+  def close(self):
+    self.map.close()
+    self.file.close()
+
+
+# Build an index at indexPath from the CSV at csvPath. Returns the number of ranges written. Ranges that overlap one
+# already taken are dropped.
+def importCsv(csvPath, indexPath, countryColumn=2, cityColumn=3):
+  ranges = []
+  with open(csvPath, 'rb') as csvFile:
+    for row in csv.reader(csvFile):
+      try:
+        first, last = addrToInt(row[0]), addrToInt(row[1])
+        country, city = row[countryColumn], row[cityColumn]
+      except (ValueError, IndexError):
+        continue
+      if first <= last:
+        ranges.append((first, last, "%s\t%s" % (city.replace("\t", " "), country.replace("\t", " "))))
+  ranges.sort()
+
+  records = []
+  names = []
+  nameOffsets = {}
+  namesSize = 0
+  dropped = 0
+  for first, last, name in ranges:
+    if records and first <= records[-1][1]:
+      dropped += 1
+      continue
+    name = name.decode('utf-8', 'replace').encode('utf-8')[:0xffff]
+    if name not in nameOffsets:
+      nameOffsets[name] = namesSize
+      names.append(NAME_LENGTH.pack(len(name)) + name)
+      namesSize += NAME_LENGTH.size + len(name)
+    records.append((first, last, nameOffsets[name]))
+  if dropped:
+    print "Dropped %d overlapping range(s)" % dropped
+
+  # Write to a temporary file and move it into place, so that a running server never maps half an index.
+  tempPath = indexPath + ".tmp"
+  with open(tempPath, 'wb') as indexFile:
+    indexFile.write(HEADER.pack(MAGIC, len(records), HEADER.size + len(records) * RECORD.size))
+    for record in records:
+      indexFile.write(RECORD.pack(*record))
+    indexFile.write("".join(names))
+  os.rename(tempPath, indexPath)
+  return len(records)
+
+
+if __name__ == "__main__":
+  if len(sys.argv) not in (3, 5):
+    sys.exit("Usage: python geoindex.py ranges.csv geoip.idx [country column] [city column]")
+  columns = [int(arg) for arg in sys.argv[3:]]
+  print "Wrote %d ranges to %s" % (importCsv(sys.argv[1], sys.argv[2], *columns), sys.argv[2])
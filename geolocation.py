@@ -0,0 +1,128 @@
+"""geolocation.py - Maps vessel ips to where in the world they are.
+
+Lookups are answered from a local geoindex.GeoIndex when one is given, and go
+to the public geoip server over XML-RPC otherwise, several at a time. A batch of
+remote lookups gives up after a deadline so that a slow or unreachable server
+can't hold up startup. Every answer is kept in memory and in the geoip table of
+viewpoints.db, so an ip is looked up again only once its entry is older than
+the TTL, even across runs.
+
+"""
+import Queue
+import sqlite3
+import threading
+import time
+import xmlrpclib
+
+
+class TimeoutTransport(xmlrpclib.Transport):
+  # xmlrpclib has no timeout of its own, so set one on each connection it makes.
+
+  def __init__(self, timeout):
+    xmlrpclib.Transport.__init__(self)
+    self.timeout = timeout
+
+  def make_connection(self, host):
+    conn = xmlrpclib.Transport.make_connection(self, host)
+    conn.timeout = self.timeout
+    return conn
+
+
+class GeoLocator:
+
+  def __init__(self, dbPath, serverUrl, ttl, workers, timeout, index=None):
+    self.serverUrl = serverUrl
+    self.index = index # A local geoindex.GeoIndex to try before the server, or None
+    self.ttl = ttl
+    self.workers = workers
+    self.timeout = timeout
+    self.records = {} # ip -> (record, time it was looked up). record is None if the server knew nothing about the ip.
+    self.lock = threading.Lock() # Guards records and conn
+    self.conn = sqlite3.connect(dbPath, check_same_thread=False)
+    self.conn.execute("CREATE TABLE IF NOT EXISTS geoip(ip text PRIMARY KEY, city text, country text, stored real)")
+    self.conn.commit()
+    for ip, city, country, stored in self.conn.execute("SELECT ip, city, country, stored FROM geoip WHERE stored > ?", \
+        (time.time() - self.ttl,)):
+      record = None
+      if city is not None or country is not None:
+        record = {'city' : city, 'country_name' : country}
+      self.records[ip] = (record, stored)
+
+  # Look up a list of ips. Returns a dict of ip -> record, a dict with 'city' and 'country_name' keys, or None if the
+  # server knows nothing about the ip. Ips that couldn't be looked up, or weren't by the time deadline seconds were up,
+  # are left out; lookups still running then keep going in the background and are cached when they finish.
+  def lookup(self, ips, deadline):
+    found = {}
+    jobs = Queue.Queue()
+    now = time.time()
+    with self.lock:
+      for ip in set(ips):
+        if ip in self.records and now - self.records[ip][1] <= self.ttl:
+          found[ip] = self.records[ip][0]
+          continue
+        # The local index answers in microseconds, so there's no point keeping its answers as well.
+        if self.index is not None:
+          record = self.index.record_by_addr(ip)
+          if record is not None:
+            found[ip] = record
+            continue
+        jobs.put(ip)
+    pending = jobs.qsize()
+    if pending == 0:
+      return found
+
+    results = Queue.Queue()
+    for i in range(min(self.workers, pending)):
+      worker = threading.Thread(target=self.lookupWorker, args=[jobs, results])
+      worker.daemon = True
+      worker.start()
+
+    end = time.time() + deadline
+    while pending > 0 and time.time() < end:
+      try:
+        ip, record, error = results.get(True, end - time.time())
+      except Queue.Empty:
+        break
+      pending -= 1
+      if error is None:
+        found[ip] = record
+      else:
+        print "Couldn't look up the location of %s: %s" % (ip, error)
+    if pending > 0:
+      print "Gave up on %d location lookup(s) after %d seconds" % (pending, deadline)
+    return found
+
+  def lookupWorker(self, jobs, results):
+    # ServerProxies can't be shared between threads, so each worker has its own.
+    server = xmlrpclib.ServerProxy(self.serverUrl, transport=TimeoutTransport(self.timeout))
+    while True:
+      try:
+        ip = jobs.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        record = server.record_by_addr(ip) or None
+      except Exception, error:
+        results.put((ip, None, str(error)))
+        continue
+      if record is not None:
+        record = {'city' : record.get('city'), 'country_name' : record.get('country_name')}
+      self.store(ip, record)
+      results.put((ip, record, None))
+
+  def store(self, ip, record):
+    stored = time.time()
+    city, country = None, None
+    if record is not None:
+      city, country = record['city'], record['country_name']
+    with self.lock:
+      self.records[ip] = (record, stored)
+      self.conn.execute("INSERT OR REPLACE INTO geoip(ip, city, country, stored) VALUES (?, ?, ?, ?)", \
+        (ip, city, country, stored))
+      self.conn.commit()
+
+  def close(self):
+    with self.lock:
+      self.conn.close()
+    if self.index is not None:
+      self.index.close()
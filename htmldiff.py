@@ -0,0 +1,236 @@
+"""htmldiff.py - Token level diffing of the proxy and local copies of a page.
+
+Pages are split into tokens (whole tags and whitespace separated words) and
+diffed with Heckel's algorithm: tokens that occur exactly once in each copy
+anchor the match, and the matches are grown outwards from those anchors. Every
+step is a single pass over the tokens, so the diff runs in linear time even on
+pages of several MB. Matches that cross each other (moved blocks) are reported
+as a delete plus an insert.
+
+The diffing happens in a worker process (see DiffEngine) so that it never
+holds up the request handlers. The worker remembers the last copy of each side
+of each page it was asked about, and when a page comes back only slightly
+changed it re-tokenizes just the part that changed. An identical pair is
+answered from the previous result outright.
+
+"""
+import bisect
+import collections
+import hashlib
+import multiprocessing
+import re
+
+# Whole tags, runs of text, and stray angle brackets. A tag can't contain '<',
+# which keeps every token boundary local to the text around it.
+TOKEN_PATTERN = re.compile(r'<[^<>]*>|[^<>\s]+|[<>]')
+
+# How many pages (url, vessel, user agent) the worker keeps tokens for.
+MAX_SLOTS = 16
+
+# Changed text longer than this is cut short in the change list.
+MAX_CHANGE_TEXT = 300
+
+
+# Returns the tokens of text from pos onwards, and the offset each of them starts at.
+def tokenize(text, pos=0):
+  tokens = []
+  starts = []
+  for match in TOKEN_PATTERN.finditer(text, pos):
+    tokens.append(match.group())
+    starts.append(match.start())
+  return tokens, starts
+
+
+# The length of the longest common prefix of a and b, found by comparing ever smaller slices rather than one
+# character at a time.
+def commonPrefix(a, b):
+  lo, hi = 0, min(len(a), len(b))
+  while lo < hi:
+    mid = (lo + hi + 1) // 2
+    if a[lo:mid] == b[lo:mid]:
+      lo = mid
+    else:
+      hi = mid - 1
+  return lo
+
+
+# The length of the longest common suffix of a and b, no longer than limit.
+def commonSuffix(a, b, limit):
+  lo, hi = 0, limit
+  while lo < hi:
+    mid = (lo + hi + 1) // 2
+    if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+      lo = mid
+    else:
+      hi = mid - 1
+  return lo
+
+
+# Re-tokenize newText given the tokens of oldText, a previous version of it. Only the region between the unchanged
+# prefix and suffix is tokenized again; tokens on either side of it are reused.
+def retokenize(oldText, oldTokens, oldStarts, newText):
+  prefix = commonPrefix(oldText, newText)
+  if prefix == len(oldText) == len(newText):
+    return oldTokens, oldStarts
+  suffix = commonSuffix(oldText, newText, min(len(oldText), len(newText)) - prefix)
+  delta = len(newText) - len(oldText)
+  suffixStart = len(oldText) - suffix
+
+  # Keep the tokens that start inside the unchanged prefix, less the last one, which the change may have extended.
+  # Whether a '<' opens a tag depends on the next bracket after it, so if the last bracket before the change is a
+  # '<' we go back to it as well.
+  kept = max(0, bisect.bisect_left(oldStarts, prefix) - 1)
+  bracket = max(oldText.rfind('<', 0, prefix), oldText.rfind('>', 0, prefix))
+  if bracket != -1 and oldText[bracket] == '<':
+    kept = min(kept, bisect.bisect_left(oldStarts, bracket))
+  restart = 0
+  if kept > 0:
+    restart = oldStarts[kept]
+
+  # Tokenize from there until we land on the start of a token in the unchanged suffix. From that point on the text,
+  # and so the tokens, are the same as last time.
+  tokens = oldTokens[:kept]
+  starts = oldStarts[:kept]
+  for match in TOKEN_PATTERN.finditer(newText, restart):
+    oldStart = match.start() - delta
+    if oldStart >= suffixStart:
+      index = bisect.bisect_left(oldStarts, oldStart)
+      if index < len(oldStarts) and oldStarts[index] == oldStart:
+        tokens.extend(oldTokens[index:])
+        starts.extend([start + delta for start in oldStarts[index:]])
+        return tokens, starts
+    tokens.append(match.group())
+    starts.append(match.start())
+  return tokens, starts
+
+
+# Heckel's algorithm. Returns a list giving, for each token of a, the index of the token of b it matches or -1.
+def matchTokens(a, b):
+  table = {} # token -> [occurrences in a, occurrences in b, index in a]
+  for i in range(len(a)):
+    entry = table.get(a[i])
+    if entry is None:
+      entry = table[a[i]] = [0, 0, i]
+    entry[0] += 1
+  for token in b:
+    entry = table.get(token)
+    if entry is not None:
+      entry[1] += 1
+
+  amap = [-1] * len(a)
+  bmap = [-1] * len(b)
+  for j in range(len(b)):
+    entry = table.get(b[j])
+    if entry is not None and entry[0] == 1 and entry[1] == 1:
+      amap[entry[2]] = j
+      bmap[j] = entry[2]
+
+  # Grow each match forwards, then backwards, over tokens that are equal but weren't unique.
+  for i in range(len(a) - 1):
+    j = amap[i]
+    if j != -1 and j + 1 < len(b) and amap[i + 1] == -1 and bmap[j + 1] == -1 and a[i + 1] == b[j + 1]:
+      amap[i + 1] = j + 1
+      bmap[j + 1] = i + 1
+  for i in range(len(a) - 1, 0, -1):
+    j = amap[i]
+    if j > 0 and amap[i - 1] == -1 and bmap[j - 1] == -1 and a[i - 1] == b[j - 1]:
+      amap[i - 1] = j - 1
+      bmap[j - 1] = i - 1
+  return amap
+
+
+# Diff two token lists. Returns difflib style opcodes, (tag, i1, i2, j1, j2), for the regions that differ.
+def diffTokens(a, b):
+  prefix = 0
+  while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+    prefix += 1
+  suffix = 0
+  while suffix < len(a) - prefix and suffix < len(b) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+    suffix += 1
+
+  amap = matchTokens(a[prefix:len(a) - suffix], b[prefix:len(b) - suffix])
+
+  # Walk the matches in order of a, keeping only those that also move forward in b.
+  opcodes = []
+  i, j = 0, 0
+  for ai in range(len(amap)):
+    bj = amap[ai]
+    if bj < j:
+      continue
+    if ai > i or bj > j:
+      opcodes.append((_opcodeTag(ai - i, bj - j), prefix + i, prefix + ai, prefix + j, prefix + bj))
+    i, j = ai + 1, bj + 1
+  ai, bj = len(a) - prefix - suffix, len(b) - prefix - suffix
+  if ai > i or bj > j:
+    opcodes.append((_opcodeTag(ai - i, bj - j), prefix + i, prefix + ai, prefix + j, prefix + bj))
+  return opcodes
+
+
+def _opcodeTag(deleted, inserted):
+  if deleted and inserted:
+    return 'replace'
+  elif deleted:
+    return 'delete'
+  return 'insert'
+
+
+# The text of a changed region, cut short if need be, and decoded so it can go out as JSON whatever the page's
+# charset.
+def _changeText(tokens, start, end):
+  text = " ".join(tokens[start:end])
+  if len(text) > MAX_CHANGE_TEXT:
+    text = text[:MAX_CHANGE_TEXT] + "..."
+  return text.decode('utf-8', 'replace')
+
+
+# Per page state kept inside the worker process: slot -> {'proxy' : (text, tokens, starts), 'local' : ...,
+# 'result' : (hashes, result)}
+_slots = collections.OrderedDict()
+
+
+def _sideTokens(state, side, text):
+  if side in state:
+    oldText, oldTokens, oldStarts = state[side]
+    tokens, starts = retokenize(oldText, oldTokens, oldStarts, text)
+  else:
+    tokens, starts = tokenize(text)
+  state[side] = (text, tokens, starts)
+  return tokens
+
+
+# Runs in the worker process. Diffs the proxy copy against the local one, reusing what we kept from the last diff of
+# the same slot.
+def diffPages(slot, proxyHtml, localHtml):
+  state = _slots.pop(slot, {})
+  _slots[slot] = state
+  while len(_slots) > MAX_SLOTS:
+    _slots.popitem(last=False)
+
+  hashes = (hashlib.sha1(proxyHtml).digest(), hashlib.sha1(localHtml).digest())
+  if 'result' in state and state['result'][0] == hashes:
+    return state['result'][1]
+
+  proxyTokens = _sideTokens(state, 'proxy', proxyHtml)
+  localTokens = _sideTokens(state, 'local', localHtml)
+  changes = []
+  for tag, i1, i2, j1, j2 in diffTokens(localTokens, proxyTokens):
+    changes.append({'op' : tag, 'local' : [i1, i2], 'proxy' : [j1, j2], \
+      'removed' : _changeText(localTokens, i1, i2), 'added' : _changeText(proxyTokens, j1, j2)})
+  result = {'changes' : changes, 'localTokens' : len(localTokens), 'proxyTokens' : len(proxyTokens)}
+  state['result'] = (hashes, result)
+  return result
+
+
+class DiffEngine:
+  # Hands diffs to a single worker process. A single worker keeps all of the per page state in one place, so
+  # incremental re-diffs always find it. Create this before starting any threads, since it forks.
+
+  def __init__(self):
+    self.pool = multiprocessing.Pool(1)
+
+  # Start diffing a page. Returns an AsyncResult whose get() gives the change list.
+  def submit(self, slot, proxyHtml, localHtml):
+    return self.pool.apply_async(diffPages, (slot, proxyHtml, localHtml))
+
+  def close(self):
+    self.pool.terminate()
@@ -9,20 +9,62 @@ can be performed.
 import os
 import sys
 import urlparse
+import urllib
 import BaseHTTPServer
 import xmlrpclib
 import urllib2
 import overlord
 import experimentlib
+import pagecache
+import htmldiff
+import geolocation
+import geoindex
+import useragents
+import staticfiles
 import sqlite3
 import cgi
+import json
+import hashlib
 import cStringIO
 import threading
+import Queue
 import time
 
 PORT_NUMBER = 8008
+# The number of worker threads serving UI requests. Requests beyond this many
+# wait in the server's queue until a worker is free.
+MAX_CONCURRENT_REQUESTS = 8
+# How many vessels a latency test talks to at once, how long any one vessel gets to answer, and how long the
+# whole test may take, in seconds.
+LATENCY_WORKERS = 10
+LATENCY_NODE_TIMEOUT = 30
+LATENCY_TOTAL_TIMEOUT = 60
+# The byte budget for cached diff-mode pages, how long an entry lives, and how long a window (in seconds) a repeat
+# diff of the same page may be served from memory rather than fetched again.
+PAGE_CACHE_BYTES = 64 * 1024 * 1024
+PAGE_CACHE_TTL = 1800
+PAGE_CACHE_BUCKET = 300
+# How long, in seconds, diff mode waits for the copy of a page loaded through the vessel and for the copy loaded locally.
+PROXY_FETCH_TIMEOUT = 60
+LOCAL_FETCH_TIMEOUT = 30
+# How long, in seconds, a request for a page's change list waits on the diff engine.
+DIFF_TIMEOUT = 60
 # A public geoip server. Thanks!
 GEO_IP_SERVER = "http://geoip.cs.washington.edu:12679"
+# How long, in seconds, a looked up location is kept, how many lookups run at once, how long any one lookup may take,
+# and how long a whole batch of them may take.
+GEO_IP_TTL = 30 * 24 * 60 * 60
+GEO_IP_WORKERS = 10
+GEO_IP_TIMEOUT = 10
+GEO_IP_DEADLINE = 20
+# A local geoip index (see geoindex.py). If it exists, it's used in place of the geoip server for every ip it covers.
+GEO_IP_INDEX = "geoip.idx"
+# The directories static files may be served from, and how long, in seconds, browsers may use their copy of a script
+# or stylesheet before checking with us. Pages are always checked, so changes to them show up straight away.
+STATIC_DIRECTORIES = ["pages", "js", "css"]
+STATIC_MAX_AGE = 60 * 60
+# How many vessels need to be running before we start serving. The rest are added as overlord brings them up.
+READY_VESSELS = 1
 
 # This is how I though you should map urls to files when I first started with python. Hey, I coulda done worse.
 html = {'/' : "pages/index.html", '/location' : "pages/location.html", \
@@ -31,62 +73,300 @@ html = {'/' : "pages/index.html", '/location' : "pages/location.html", \
 posts = ["/geni/renew_resources", "/viewpoints/proxy/single/getpage", \
   "/viewpoints/proxy/bulk/gettimes"]
 
+# The lists the index page fills its drop downs from. See sendOptions.
+optionLists = ["/locations", "/platforms", "/browsers"]
+
 nodes = []
 vessels = []
 locations = []
 geoipserver = None
 
+class ViewpointsServer(BaseHTTPServer.HTTPServer):
+  # An HTTPServer that hands accepted connections to a fixed pool of worker
+  # threads, so one slow proxy fetch doesn't hold up every other request.
+  # The shared database connection is guarded by connLock; the page cache
+  # does its own locking. diffEngine forks its worker process, so it has to
+  # be created before any threads are started, and is passed in.
+  
+  def __init__(self, address, handler, diffEngine, workers=MAX_CONCURRENT_REQUESTS):
+    BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+    self.requestQueue = Queue.Queue()
+    self.connLock = threading.Lock()
+    self.pageCache = pagecache.PageCache(PAGE_CACHE_BYTES, PAGE_CACHE_TTL, PAGE_CACHE_BUCKET)
+    self.optionCache = {} # list -> (what it was built from, body, etag). See ViewpointsHandler.sendOptions.
+    self.staticFiles = staticfiles.StaticFiles('.', STATIC_DIRECTORIES)
+    self.diffEngine = diffEngine
+    for i in range(workers):
+      worker = threading.Thread(target=self.serveQueue)
+      worker.daemon = True
+      worker.start()
+  
+  # Each worker pulls connections off the queue and handles them one at a time.
+  def serveQueue(self):
+    while True:
+      request, client_address = self.requestQueue.get()
+      try:
+        self.finish_request(request, client_address)
+      except:
+        self.handle_error(request, client_address)
+      self.shutdown_request(request)
+  
+  # Called by serve_forever for every accepted connection. Queue it for a worker instead of handling it inline.
+  def process_request(self, request, client_address):
+    self.requestQueue.put((request, client_address))
+
 class ViewpointsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   
   def addrToName(addr):
     return geoipserver.record_by_addr(addr)
   
   # Make what will somday be a RPC, but for now is just an HTTP request to the current node for the latency from the node to the site requested.
-  def setLatValue(self, ip, url, numTests, list):
+  def setLatValue(self, ip, url, numTests, timeout):
     print "Setting Latency!"
     proxy = "http://%s:%s/latency" % (ip, 63138)
     data = 'page=%s&numTests=%s' % (url[0], numTests[0])
     print "%s : %s" % (proxy, data)
-    load = urllib2.urlopen(proxy, data)
+    load = urllib2.urlopen(proxy, data, timeout)
     text = load.read()
     print text
-    list[ip] = text
+    return text
+  
+  # Write a single Server-Sent Event to the client and push it out right away.
+  def sendEvent(self, event, data):
+    self.wfile.write("event: %s\ndata: %s\n\n" % (event, json.dumps(data)))
+    self.wfile.flush()
     
-	# For each node, get it to do a basic latency test, and store it in a dictionary keyed by the node's ip address
+	# For each node, get it to do a basic latency test, and stream each node's result back as soon as it arrives.
+  # A bounded pool of workers does the fetching. Nodes that take longer than LATENCY_NODE_TIMEOUT, or that haven't
+  # answered by the time LATENCY_TOTAL_TIMEOUT runs out, are reported as timed out rather than holding up the rest.
   def latencyTest(self, params):
-    latencyDict = {}
-    for key in self.server.locations.keys():
-      run = threading.Thread(target=self.setLatValue, args=[key, params['url'], params['numTests'], latencyDict])
+    locations = self.server.locations.items()
+    jobs = Queue.Queue()
+    results = Queue.Queue()
+    started = {} # ip -> time its worker started on it
+    stop = threading.Event()
+    deadline = time.time() + LATENCY_TOTAL_TIMEOUT
+    for ip, location in locations:
+      jobs.put(ip)
+      
+    def worker():
+      while not stop.isSet() and time.time() < deadline:
+        try:
+          ip = jobs.get_nowait()
+        except Queue.Empty:
+          return
+        started[ip] = time.time()
+        try:
+          results.put((ip, self.setLatValue(ip, params['url'], params['numTests'], LATENCY_NODE_TIMEOUT), None))
+        except Exception, error:
+          results.put((ip, None, str(error)))
+    
+    for i in range(min(LATENCY_WORKERS, len(locations))):
+      run = threading.Thread(target=worker)
+      run.daemon = True
       run.start()
-    print latencyDict
-    return "%s" % latencyDict
+    
+    self.send_response(200)
+    self.send_header("Content-Type", "text/event-stream")
+    self.send_header("Cache-Control", "no-cache")
+    self.end_headers()
+    
+    names = dict((ip, location[1]) for ip, location in locations)
+    pending = set(names.keys())
+    try:
+      while pending:
+        now = time.time()
+        # Report anything that has run past its own deadline before waiting again.
+        for ip in [ip for ip in pending if ip in started and now - started[ip] > LATENCY_NODE_TIMEOUT]:
+          pending.discard(ip)
+          self.sendEvent("result", {"ip" : ip, "loc" : names[ip], "error" : "Timed out"})
+        if not pending or now >= deadline:
+          break
+        # Wake up for the next result, the next node deadline or the overall deadline, whichever comes first.
+        wait = deadline - now
+        for ip in pending:
+          if ip in started:
+            wait = min(wait, started[ip] + LATENCY_NODE_TIMEOUT - now)
+        try:
+          ip, text, error = results.get(timeout=max(wait, 0.01))
+        except Queue.Empty:
+          continue
+        if ip not in pending: # Already reported as timed out
+          continue
+        pending.discard(ip)
+        if error is None:
+          self.sendEvent("result", {"ip" : ip, "loc" : names[ip], "latency" : text, "elapsed" : time.time() - started[ip]})
+        else:
+          self.sendEvent("result", {"ip" : ip, "loc" : names[ip], "error" : error})
+      for ip in pending:
+        self.sendEvent("result", {"ip" : ip, "loc" : names[ip], "error" : "Timed out"})
+      self.sendEvent("done", {"count" : len(locations)})
+    finally:
+      stop.set() # Don't let the workers start on nodes nobody is waiting for anymore.
       
       
+  # Fetch a url (POSTing data, if there is any) on its own thread. Returns the thread and a dict that ends up holding
+  # either the response 'body' or the 'error' that stopped us getting it.
+  def fetchInBackground(self, request, data, timeout):
+    result = {}
+    def fetch():
+      try:
+        result['body'] = urllib2.urlopen(request, data, timeout).read()
+      except Exception, error:
+        result['error'] = str(error)
+    run = threading.Thread(target=fetch)
+    run.daemon = True
+    run.start()
+    return run, result
+  
+  # Stands in for a copy of the page we couldn't load, so the diff page can still show the other one.
+  def fetchErrorPage(self, side, error):
+    return "<html><body>Could not load the %s copy of this page: %s</body></html>" % (side, cgi.escape(error))
+  
+  # The change list between the two copies of a diffed page, as JSON. The diff engine started on it when the page was
+  # loaded, so this mostly just collects the result.
+  def diffResult(self, params):
+    entry = self.server.pageCache.get(params.get('id', [''])[0])
+    if entry is None or 'diff' not in entry:
+      return json.dumps({"error" : "No such diff"})
+    try:
+      return json.dumps(entry['diff'].get(DIFF_TIMEOUT))
+    except Exception, error:
+      return json.dumps({"error" : "Diff failed: %s" % error})
+  
+  # Send a JSON body that browsers shouldn't keep.
+  def sendJson(self, body):
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.send_header("Cache-Control", "no-cache")
+    self.end_headers()
+    self.wfile.write(body)
+
+  # Send one of the option lists as JSON. Each is built from an object that is replaced, never changed, when what it
+  # lists changes (server.locations, or the agent catalogue), so a list is only serialized again when that object
+  # isn't the one it was last built from. Clients that send the ETag of the current list get a 304 instead.
+  def sendOptions(self, page, params):
+    if page == "/locations": # The locations at which we have seattle servers
+      source = self.server.locations
+      key = page
+      build = lambda: [{"ip" : ip, "loc" : location[1]} for ip, location in sorted(source.items())]
+    elif page == "/platforms": # The operating systems that the user can emulate with our saved user agent strings
+      source = self.server.agents.current()
+      key = page
+      build = lambda: [{"id" : rowId, "desc" : name} for rowId, name in source['platforms']]
+    else: # The browsers available for the os the user has selected
+      source = self.server.agents.current()
+      try:
+        osId = int(params.get('id', [''])[0])
+      except ValueError:
+        osId = None
+      key = None # Only lists for real oses are kept, so requests can't fill the cache with junk
+      if osId in source['browsers']:
+        key = (page, osId)
+      build = lambda: [{"id" : rowId, "desc" : desc} for rowId, desc in source['browsers'].get(osId, [])]
+
+    cached = self.server.optionCache.get(key)
+    if cached is None or cached[0] is not source:
+      body = json.dumps({"options" : build()})
+      cached = (source, body, '"%s"' % hashlib.sha1(body).hexdigest())
+      if key is not None:
+        self.server.optionCache[key] = cached
+    source, body, etag = cached
+
+    if self.headers.getheader('if-none-match') == etag:
+      self.send_response(304)
+      self.send_header("ETag", etag)
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.send_header("ETag", etag)
+    self.send_header("Cache-Control", "no-cache") # Keep it, but check with us before using it again
+    self.end_headers()
+    self.wfile.write(body)
+
+  # Send a static file, or the 404 page if it doesn't exist or isn't under one of the STATIC_DIRECTORIES. Browsers that
+  # already have the current copy (by ETag, or failing that by date) get a 304, and those that take gzip get the
+  # compressed copy.
+  def sendStatic(self, path):
+    asset = self.server.staticFiles.get(path)
+    status = 200
+    if asset is None:
+      asset = self.server.staticFiles.get("pages/404.html")
+      status = 404
+
+    if asset['type'].startswith("text/html"):
+      cacheControl = "no-cache"
+    else:
+      cacheControl = "max-age=%d" % STATIC_MAX_AGE
+    etag = self.headers.getheader('if-none-match')
+    if status == 200 and (etag == asset['etag'] or \
+        (etag is None and self.headers.getheader('if-modified-since') == asset['lastModified'])):
+      self.send_response(304)
+      self.send_header("ETag", asset['etag'])
+      self.send_header("Cache-Control", cacheControl)
+      self.end_headers()
+      return
+
+    body = asset['body']
+    self.send_response(status)
+    self.send_header("Content-Type", asset['type'])
+    if asset['gzip'] is not None:
+      self.send_header("Vary", "Accept-Encoding")
+      if 'gzip' in (self.headers.getheader('accept-encoding') or ''):
+        body = asset['gzip']
+        self.send_header("Content-Encoding", "gzip")
+    self.send_header("Content-Length", str(len(body)))
+    if status == 200:
+      self.send_header("ETag", asset['etag'])
+      self.send_header("Last-Modified", asset['lastModified'])
+      self.send_header("Cache-Control", cacheControl)
+    self.end_headers()
+    self.wfile.write(body)
+
   # Load the page, either from both viewpoints server location and the requested node, or just from the node if they haven't requested a diff
   def loadPage(self, params):
     try:
-      c = self.server.conn.cursor()
-      c.execute('select agentstring from useragents where rowId=%s' % params['browser'][0])
-      agent = c.fetchone()[0]
+      agent = self.server.agents.agentString(params['browser'][0])
       self.server.curPage = params['url']
       print params['url']
       url = "http://%s:%s/page" % (params['loc'][0], 63138)
       data = 'page=%s&useragent=%s' % (params['url'][0], agent)
       print "%s : %s" % (url, data)
-      proxyPage = urllib2.urlopen(url, data)
       print params['diff']
       if params['diff'][0] == '1':
         print "Diff"
-        self.server.proxyCache = proxyPage.read() # Store the html from the proxy loaded page
-        request = urllib2.Request(params['url'][0], headers={"User-Agent": agent})
-        localPage = urllib2.urlopen(request) 
-        self.server.localCache = localPage.read() # Store the html from the locally loaded page
-        diffpage = open('pages/diff.html', 'r')
-        #print diffpage
-        return diffpage
+        # Each diff gets its own cache entry, which the diff page's iframes load by ID. Repeat diffs of the same page
+        # from the same vessel and user agent are served from memory, without another trip through the vessel.
+        entryId = self.server.pageCache.makeId(params['url'][0], params['loc'][0], agent)
+        entry = self.server.pageCache.get(entryId)
+        if entry is None or not entry['complete']:
+          # The vessel and local fetches don't depend on each other, so run them side by side. If either one fails or
+          # runs out of time, the diff still renders with whatever we did get.
+          start = time.time()
+          proxyFetch, proxyResult = self.fetchInBackground(url, data, PROXY_FETCH_TIMEOUT)
+          request = urllib2.Request(params['url'][0], headers={"User-Agent": agent})
+          localFetch, localResult = self.fetchInBackground(request, None, LOCAL_FETCH_TIMEOUT)
+          proxyFetch.join(max(0, start + PROXY_FETCH_TIMEOUT - time.time()))
+          localFetch.join(max(0, start + LOCAL_FETCH_TIMEOUT - time.time()))
+          proxyHtml = proxyResult.get('body') # The html from the proxy loaded page
+          localHtml = localResult.get('body') # The html from the locally loaded page
+          complete = proxyHtml is not None and localHtml is not None
+          if proxyHtml is None:
+            proxyHtml = self.fetchErrorPage("vessel", proxyResult.get('error', "Timed out"))
+          if localHtml is None:
+            localHtml = self.fetchErrorPage("local", localResult.get('error', "Timed out"))
+          entry = self.server.pageCache.put(entryId, proxyHtml, localHtml, complete)
+          # Work out the change list in the background while the browser loads the two copies.
+          slot = (params['url'][0], params['loc'][0], agent)
+          entry['diff'] = self.server.diffEngine.submit(slot, proxyHtml, localHtml)
+        diffpage = open('pages/diff.html', 'r').read().replace('{{id}}', entryId)
+        return cStringIO.StringIO(diffpage)
       else:
         print "No Diff"
-        return proxyPage # If we're not diffing the html between the local and remote versions, just load the remote version!
+        return urllib2.urlopen(url, data) # If we're not diffing the html between the local and remote versions, just load the remote version!
     except Exception, error: 
       print "Error: %s" % error.reason
       print self.server.vessels # Sometimes overlord dumps vessels, even after we waited before assigning them to our application. 
@@ -100,18 +380,29 @@ class ViewpointsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     print "GET: %s" % page
     if page == "/location":
       f = self.loadPage(urlparse.parse_qs(parse.query)).read()
-    elif page == "/latency":
-      f = self.latencyTest(urlparse.parse_qs(parse.query))
-    elif page == "/proxyCache": # The page diff page loads each page (remote or otherwise) in an iframe. This is where the proxy page is stored, and the iframe just points here
-      f = self.server.proxyCache
-    elif page == "/localCache": # The same as earlier, just for the local version of the page
-      f = self.server.localCache
+    elif page == "/latency": # Streamed straight to the client as the vessels answer
+      self.latencyTest(urlparse.parse_qs(parse.query))
+      return
+    elif page == "/diff":
+      self.sendJson(self.diffResult(urlparse.parse_qs(parse.query)))
+      return
+    elif page in optionLists:
+      self.sendOptions(page, urlparse.parse_qs(parse.query))
+      return
+    elif page in ("/proxyCache", "/localCache"): # The page diff page loads each page (remote or otherwise) in an iframe, pointed here with the ID of its cache entry
+      entry = self.server.pageCache.get(urlparse.parse_qs(parse.query).get('id', [''])[0])
+      if entry is None:
+        f = self.server.staticFiles.get("pages/404.html")['body']
+      elif page == "/proxyCache":
+        f = entry['proxy']
+      else:
+        f = entry['local']
     elif page in html.keys():	# If we've recieved a request for a static page, serve it up!
-      f = open(html[page], 'r').read()
-    elif os.path.exists(page[1:]): # If we've got a request for a file that exists on the server, serve it up! In case you can't tell, this is at the moment utterly unrestricted and generally a bad idea. :)
-      f = open(page[1:], 'r').read()
-    else:
-      f = open("pages/404.html", 'r').read()
+      self.sendStatic(html[page])
+      return
+    else: # Anything else is a file, which is served only from the STATIC_DIRECTORIES
+      self.sendStatic(urllib.unquote(page))
+      return
     self.wfile.write(f)
 
   def do_POST(self):
@@ -120,6 +411,7 @@ class ViewpointsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     page = parse.path
     print "POST: %s" % page
     #Get any posted variables, consider other content types.
+    postvars = {}
     if  self.headers.getheader('content-type'):
       ctype, pdict = cgi.parse_header(self.headers.getheader('content-type'))
       if ctype == 'multipart/form-data':
@@ -130,38 +422,64 @@ class ViewpointsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       else: 
         postvars= {}
     
-    #TODO: Make this suck less (It's returning hand-made JSON. Bleh)
-    if page == "/locations":	# Serve up the list of locations at which we have seattle servers
-      locationList = '{ "options" : ['
-      for key in self.server.locations.keys():
-        locationList += '{"ip" : "%s", "loc": "%s"},' % (key, self.server.locations[key][1])
-      locationList = locationList[0:-1] + ']}'
-      self.wfile.write(locationList)
-      print locationList 
-    elif page == "/browsers":  # Get the list of browsers available for the os the user has selected (for the user agent)
-      c = self.server.conn.cursor()
-      browserList = '{ "options" : ['
-      for row in c.execute('select rowId, description from useragents where os=%s' % postvars['id'][0]):
-        browserList += '{"id" : "%s", "desc" : "%s"},' % (row[0], row[1])
-      browserList = browserList[0:-1] + ']}'
-      self.wfile.write(browserList)
-    elif page == "/platforms": # Get the list of operating systems that the user can emulate with our various saved user agent strings
-      print "Platforms"
-      c = self.server.conn.cursor()
-      print c
-      platList = '{ "options" : ['
-      for row in c.execute('select rowId, name from os'):
-        print row
-        platList += '{"id" : "%s", "desc" : "%s"},' % (row[0], row[1])
-      platList = platList[0:-1] + ']}'
-      print platList
-      self.wfile.write(platList)
+    # The option lists are also served over GET, which lets browsers revalidate them; this is for older pages.
+    if page in optionLists:
+      self.sendOptions(page, postvars)
       
 
 
+# Called by overlord whenever vessels start or stop. Locations of stopped vessels are dropped straight away; new ones
+# are looked up in the background so that overlord isn't held up. server.locations is replaced rather than changed in
+# place, so handlers can read it without taking the lock.
+def updateLocations(server, added, removed, debug):
+  with server.locationLock:
+    server.locations = dict([(ip, location) for ip, location in server.locations.items() if location[0] not in removed])
+    server.vessels = overlord.get_active_vessels()
+  if added:
+    lookup = threading.Thread(target=addLocations, args=[server, added, debug])
+    lookup.daemon = True
+    lookup.start()
+
+
+# Map the ips of new vessels to actual locations and add them to the server's list.
+def addLocations(server, vessels, debug):
+  ips = {}
+  for vessel in vessels:
+    nodeid, vesselname = vessel.split(":")
+    try:
+      location = experimentlib.get_node_location(nodeid).split(":")[0]
+    except experimentlib.SeattleExperimentError, e:
+      print "Couldn't find node for %s: %s" % (vessel, e)
+      continue
+    if debug:
+      try:
+        log = experimentlib.get_vessel_log(vessel, server.config['identity'])
+        print "Log for %s: %s" % (location, log)
+      except:
+        print "Unnexpected Error: %s" % sys.exc_info()[0]
+    ips[location] = vessel
+
+  records = server.geoLocator.lookup(ips.keys(), GEO_IP_DEADLINE)
+  found = {}
+  for location, vessel in ips.items():
+    loc = records.get(location)
+    if loc is not None:
+      found[location] = [vessel, "%s - %s" % (loc['city'], loc['country_name'])]
+    else:
+      found[location] = [vessel, "%s (No Location Data)" % location]
+
+  with server.locationLock:
+    locations = dict(server.locations)
+    active = overlord.get_active_vessels()
+    for ip, location in found.items():
+      if location[0] in active: # It may have stopped while we were looking it up
+        locations[ip] = location
+    server.locations = locations
+
+
 def main():
-	# Get the user, so we can find the ssh keys. Also check if the app is run in debug mode so we can print everything!
-	user = sys.argv[1]
+  # Get the user, so we can find the ssh keys. Also check if the app is run in debug mode so we can print everything!
+  user = sys.argv[1]
   debug = False
   if len(sys.argv) == 3:
     user = sys.argv[2] + user 
@@ -174,51 +492,49 @@ def main():
       " in current working directory or at the location specified."
     sys.exit("Exit: Missing core ViewPoints Resources")
     
-  # Tell overlord (the slightly modified version) to distribute 10 instances of the newproxy(pre-processed) to various seattle nodes
-  init_dict = overlord.init(user, 10, 'wan', 'newproxypp.repy')
+  # The diff engine forks its worker process, which has to happen before overlord or anything else starts a thread.
+  diffEngine = htmldiff.DiffEngine()
+
+  # Tell overlord (the slightly modified version) to distribute 10 instances of the newproxy(pre-processed) to various seattle nodes,
+  # keeping any that are still running from our last run
+  init_dict = overlord.init(user, 10, 'wan', 'newproxypp.repy', warm_restart=True)
   config = overlord.get_config()
   run = threading.Thread(target=overlord.run, args=[init_dict['geni_port']])
   run.start()
   
-  # Wait a bit, overlord needs its time if you don't want it to throw up everywhere
-  time.sleep(60)
-
-	# Get the geoipserver so that we can map the ips of our nodes to actual locations
-  locations = {}  
-  geoipserver = xmlrpclib.ServerProxy(GEO_IP_SERVER)
-
-  for vessel in overlord.get_vessels():
-    nodeid, vesselname = vessel.split(":")
-    location = experimentlib.get_node_location(nodeid).split(":")[0]
-    locations[location] = [vessel]
-    if debug:
-      try:
-        log = experimentlib.get_vessel_log(vessel, config['identity'])
-        print "Log for %s: %s" (location, log) 
-      except:
-        print "Unnexpected Error: %s" % sys.exc_info()[0]
-    try:
-      loc = geoipserver.record_by_addr(location)
-      locations[location].append("%s - %s" % (loc['city'], loc['country_name'])) 
-    except:
-      locations[location].append("%s (No Location Data)" % location)
   conn = None  
   
   # Connect to our local database, which contains the user agent strings and their associated OSs.
+  # The connection is shared by the server's worker threads, which serialize on server.connLock.
   try:
-    conn = sqlite3.connect('viewpoints.db')
+    conn = sqlite3.connect('viewpoints.db', check_same_thread=False)
   except:
     print("Error: Database connection failure. Cannot launch viewpoints")
     sys.exit("Exit: Missing core ViewPoints Resources") 
     
   # Start up the server! When ^c is pressed, it will still take up to a few minutes for overlord to catch up and shut down.
   try:
-    server = BaseHTTPServer.HTTPServer(('', PORT_NUMBER), ViewpointsHandler)
-    server.locations = locations
+    server = ViewpointsServer(('', PORT_NUMBER), ViewpointsHandler, diffEngine)
+    server.locations = {}
+    server.locationLock = threading.Lock()
+    geoIndex = None
+    if os.path.exists(GEO_IP_INDEX):
+      geoIndex = geoindex.GeoIndex(GEO_IP_INDEX)
+    server.geoLocator = geolocation.GeoLocator('viewpoints.db', GEO_IP_SERVER, GEO_IP_TTL, GEO_IP_WORKERS, GEO_IP_TIMEOUT, \
+      geoIndex)
     server.config = config
     server.overlord = overlord
-    server.vessels = overlord.get_vessels()
+    server.vessels = []
     server.conn = conn
+    server.agents = useragents.AgentCatalogue(conn, server.connLock, 'viewpoints.db')
+    overlord.add_vessel_listener(lambda added, removed: updateLocations(server, added, removed, debug))
+
+    # Start serving as soon as there's a vessel to serve from. Locations are added as more of them come up.
+    print 'Waiting for vessels...'
+    while not overlord.wait_for_vessels(READY_VESSELS, 10):
+      if not run.isAlive():
+        sys.exit("Exit: Overlord stopped before any vessels were ready")
+      print 'Still waiting for vessels...'
     print 'Starting local ViewPoints server...'
     server.serve_forever()
     print 'Server running on port %d' % PORT_NUMBER
@@ -226,7 +542,9 @@ def main():
     print 'Break request recieved. Shutting down server.'
     overlord.KEEP_RUNNING = False
     server.conn.close()
+    server.geoLocator.close()
     server.socket.close()
+    server.diffEngine.close()
 
 
 if __name__ == "__main__":
@@ -54,8 +54,11 @@
 
 """
 
+import hashlib
 import os
 import sys
+import tempfile
+import threading
 import time
 sys.path.append("experimentlibrary")
 import experimentlib as explib
@@ -74,8 +77,29 @@ LOG_AFTER_THIS_MANY_LOOPS = 96
 # How often to renew vessels, in seconds
 VESSEL_RENEWAL_PERIOD = 518400
 
+# How many vessels to upload the program to at once
+UPLOAD_THREADS = 10
+
+# How many vessels to start the program on at once, and how long to wait, in
+# seconds, for each round of that many starts before counting the rest as
+# failed
+START_THREADS = 10
+START_DEADLINE = 60
+
+# Whether to fetch and log every vessel's log on each pass of the main loop,
+# rather than only the logs of vessels that have stopped
+FETCH_VESSEL_LOGS = False
+
 KEEP_RUNNING = True
 
+# The vessels the program is known to be running on, kept up to date by run().
+# Guarded by _active_vessels_condition, which is notified whenever the set
+# changes, and reported to the functions registered with
+# add_vessel_listener().
+_active_vessels = []
+_active_vessels_condition = threading.Condition()
+_vessel_listeners = []
+
 # Dictionary of configuration info
 config = {
   'identity': None,
@@ -84,12 +108,13 @@ config = {
   'logfile': '',
   'vesselcount': 0,
   'vesseltype': '',
-  'program_filename': ''
+  'program_filename': '',
+  'warm_restart': False
   }
 
 
   
-def init(geni_username, vesselcount, vesseltype, program_filename):
+def init(geni_username, vesselcount, vesseltype, program_filename, warm_restart=False):
   """
   <Purpose>
     Initializes the deployment of an arbitrary service. Populates a global
@@ -116,6 +141,11 @@ def init(geni_username, vesselcount, vesseltype, program_filename):
       constants within experimentlib.py
     program_filename
       The filename of the program to deploy and monitor on vessels.
+    warm_restart
+      (optional) If True, run() keeps vessels that were acquired before it
+      started and are still running the current version of the program,
+      rather than releasing every vessel and starting from scratch. See
+      adopt_vessels().
 
   <Exceptions>
     ValueError
@@ -158,6 +188,7 @@ def init(geni_username, vesselcount, vesseltype, program_filename):
   if vesselcount > num_vslcredits:
     raise ValueError('Invalid number of vessels specified. The number of deployed vessels must be less than or equal to the user\'s number of vessel credits.')
   config['vesselcount'] = vesselcount
+  config['warm_restart'] = warm_restart
 
 
   # Create and populate the return dict
@@ -224,8 +255,14 @@ def acquire_vessels(number):
 def upload_to_vessels(vesselhandle_list, filename):
   """
   <Purpose>
-    Uploads a file to a set of vessels. A batch wrapper around the Experiment
-    Library function upload_file_to_vessel, with logging support.
+    Uploads a file to a set of vessels, UPLOAD_THREADS vessels at a time. A
+    batch wrapper around the Experiment Library function
+    upload_file_to_vessel, with logging support.
+
+    Alongside the file, each vessel is given an empty marker file named after
+    the file and the SHA-1 of its contents (e.g. program.repy.<sha1>). Vessels
+    that already have the file and the marker for the current contents are
+    skipped.
 
   <Arguments>
     vesselhandle_list
@@ -247,27 +284,36 @@ def upload_to_vessels(vesselhandle_list, filename):
   config['logfile'].write(str(time.time()) + ': Uploading ' + filename + ' to '+ str(len(vesselhandle_list)) + ' vessel(s)...\n')
   config['logfile'].flush()
 
+  filehash = _file_hash(filename)
 
-  # Initially set return list equal to argument vesselhandle list
-  success_list = vesselhandle_list
-  failed_list = []
-  # For each vesselhandle, attempt an upload
-  for vh in vesselhandle_list:
-    try:
-      print "UPLOADING:%s  - %s" % (vh, filename)
-      explib.upload_file_to_vessel(vh, config['identity'], filename)
-    except explib.NodeCommunicationError, e:
-      # If upload failed, remove from vesselhandle_list...
-      success_list.remove(vh)
-      # ...add to failed_list...
-      failed_list.append(vh)
-      # ...and lookup the nodelocation so it can be logged
-      nodeid, vesselname = explib.get_nodeid_and_vesselname(vh)
-      nodelocation = explib.get_node_location(nodeid)
-      config['logfile'].write('Failure on vessel ' + nodelocation + '\n')
-      config['logfile'].write('Error was: ' + str(e) + '\n')
-      config['logfile'].flush()
-      
+  # The marker file's contents don't matter, only its name
+  markerfd, markerfilename = tempfile.mkstemp()
+  os.close(markerfd)
+
+  try:
+    uploaded_list, failed_list = explib.run_parallelized(vesselhandle_list, _upload_if_changed,
+                                                         filename, filehash, markerfilename,
+                                                         num_threads=UPLOAD_THREADS)
+  finally:
+    os.remove(markerfilename)
+
+  success_list = []
+  skipped = 0
+  for vh, uploaded in uploaded_list:
+    success_list.append(vh)
+    if not uploaded:
+      skipped += 1
+  config['logfile'].write(str(time.time()) + ': Uploaded to ' + str(len(success_list) - skipped) + ' vessel(s), ' + str(skipped) + ' already had it\n')
+
+  # Lookup the nodelocation of failed vessels so they can be logged
+  for vh, error in failed_list:
+    nodeid, vesselname = explib.get_nodeid_and_vesselname(vh)
+    nodelocation = explib.get_node_location(nodeid)
+    config['logfile'].write('Failure on vessel ' + nodelocation + '\n')
+    config['logfile'].write('Error was: ' + error + '\n')
+  config['logfile'].flush()
+
+  failed_list = [vh for vh, error in failed_list]
   release_vessels(failed_list, 'Releasing ' + str(len(failed_list)) + ' vessels to which upload failed...')
   return success_list
 
@@ -275,12 +321,86 @@ def upload_to_vessels(vesselhandle_list, filename):
 
 
 
+def _upload_if_changed(vh, filename, filehash, markerfilename):
+  """
+  Uploads filename to a vessel, unless it already has this version of it.
+  Called through run_parallelized by upload_to_vessels. Returns True if the
+  file was uploaded and False if the upload was skipped.
+  """
+  remote_filename = os.path.basename(filename)
+  marker = remote_filename + '.' + filehash
+  remote_file_list = explib.get_vessel_file_list(vh, config['identity'])
+  if remote_filename in remote_file_list and marker in remote_file_list:
+    return False
+
+  # Drop markers for older versions first, so that a marker is never left
+  # next to a file that doesn't match it.
+  for remote_file in remote_file_list:
+    if _is_marker_for(remote_file, remote_filename) and remote_file != marker:
+      explib.delete_file_in_vessel(vh, config['identity'], remote_file)
+
+  print "UPLOADING:%s  - %s" % (vh, filename)
+  explib.upload_file_to_vessel(vh, config['identity'], filename)
+  explib.upload_file_to_vessel(vh, config['identity'], markerfilename, marker)
+  return True
+
+
+
+
+
+def _has_current_program(vh, filename, filehash):
+  """
+  Returns True if a vessel has this version of filename, going by the marker
+  upload_to_vessels leaves next to it.
+  """
+  remote_filename = os.path.basename(filename)
+  remote_file_list = explib.get_vessel_file_list(vh, config['identity'])
+  return remote_filename in remote_file_list and \
+      remote_filename + '.' + filehash in remote_file_list
+
+
+
+
+
+def _file_hash(filename):
+  """
+  Returns the SHA-1 hex digest of a local file's contents.
+  """
+  fileobj = open(filename, 'rb')
+  filehash = hashlib.sha1(fileobj.read()).hexdigest()
+  fileobj.close()
+  return filehash
+
+
+
+
+
+def _is_marker_for(remote_file, remote_filename):
+  """
+  Returns True if remote_file is an upload marker (see upload_to_vessels) for
+  remote_filename.
+  """
+  prefix = remote_filename + '.'
+  digest = remote_file[len(prefix):]
+  return remote_file.startswith(prefix) and len(digest) == 40 and \
+      digest.strip('0123456789abcdef') == ''
+
+
+
+
+
 def run_on_vessels(vesselhandle_list, filename, *args):
   """
   <Purpose>
     Runs a program on a set of vessels. A batch wrapper around the Experiment
     Library function run_parallelized, with logging support.
 
+    The program is started on START_THREADS vessels at a time, and the time
+    each start took is logged. The batch gets START_DEADLINE seconds for
+    every round of START_THREADS vessels, so that vessels waiting their turn
+    aren't cut off; vessels that haven't started by then are counted as
+    failed, so that the caller can replace them.
+
   <Arguments>
     vesselhandle_list
       A list of vesselhandles of vessels to which a file is to be uploaded.
@@ -312,17 +432,32 @@ def run_on_vessels(vesselhandle_list, filename, *args):
   success_list = []
   failed_list = []
 
-  # Attempt to run program on each vessel
-  for vh in vesselhandle_list:
-    try:
-      # Note: list comp used to turn *args tuple into list of strings
-      explib.start_vessel(vh, config['identity'], filename, [str(i) for i in list(args)])
-    except explib.SeattleExperimentError, e:
-      # If failure detected, add vessel to failed_list
+  # Allow START_DEADLINE for each round of starts
+  rounds = (len(vesselhandle_list) + START_THREADS - 1) / START_THREADS
+  deadline = START_DEADLINE * max(rounds, 1)
+
+  # Log each vessel as soon as its start finishes.
+  # Note: list comp used to turn *args tuple into list of strings
+  started = explib.run_parallelized_as_completed(vesselhandle_list, _start_and_time, filename,
+                                                 [str(i) for i in list(args)],
+                                                 num_threads=START_THREADS, timeout=deadline)
+
+  for (vh, result, timeout_error) in started:
+    if timeout_error is not None:
+      # _start_and_time doesn't raise, so this is a straggler: count it as failed
       failed_list.append(vh)
+      config['logfile'].write('Vessel ' + vh + ' did not start within ' + str(deadline) + 's\n')
     else:
-      # If execution successful, add vessel to success_list
-      success_list.append(vh)
+      error, elapsed = result
+      if error is None:
+        # If execution successful, add vessel to success_list
+        success_list.append(vh)
+        config['logfile'].write('Vessel ' + vh + ' started in ' + ('%.2f' % elapsed) + 's\n')
+      else:
+        # If failure detected, add vessel to failed_list
+        failed_list.append(vh)
+        config['logfile'].write('Vessel ' + vh + ' failed to start after ' + ('%.2f' % elapsed) + 's: ' + error + '\n')
+    config['logfile'].flush()
 
   return success_list, failed_list
 
@@ -330,6 +465,23 @@ def run_on_vessels(vesselhandle_list, filename, *args):
 
 
 
+def _start_and_time(vh, filename, arg_list):
+  """
+  Starts the program on a vessel. Returns a tuple of the error, or None if
+  there wasn't one, and how long the start took. Called through
+  run_parallelized_as_completed by run_on_vessels.
+  """
+  starttime = time.time()
+  try:
+    explib.start_vessel(vh, config['identity'], filename, arg_list)
+  except Exception, e:
+    return (str(e), time.time() - starttime)
+  return (None, time.time() - starttime)
+
+
+
+
+
 def release_vessels(vesselhandle_list, log_string):
   """
   <Purpose>
@@ -378,6 +530,168 @@ def release_vessels(vesselhandle_list, log_string):
 
 
 
+def check_vessels(vesselhandle_list):
+  """
+  <Purpose>
+    Checks the health of a set of vessels. The vessels' nodes are each browsed
+    once, in parallel (see the Experiment Library function
+    get_vessel_statuses). The logs of vessels that aren't running are fetched
+    and logged, unless their node couldn't be reached, as are the logs of all
+    vessels if FETCH_VESSEL_LOGS is set.
+
+  <Arguments>
+    vesselhandle_list
+      A list of vesselhandles of vessels to check.
+
+  <Exceptions>
+    None
+
+  <Side Effects>
+    None
+
+  <Returns>
+    A list of vesselhandles of vessels that are not in the started state,
+    including those whose node couldn't be reached.
+  """
+  if not vesselhandle_list:
+    return []
+
+  try:
+    status_dict = explib.get_vessel_statuses(vesselhandle_list, config['identity'])
+  except explib.SeattleExperimentError, e:
+    # Couldn't check at all; assume the vessels are fine until the next pass
+    config['logfile'].write(str(time.time()) + ': Vessel health check failed: ' + str(e) + '\n')
+    config['logfile'].flush()
+    return []
+
+  stopped_vessel_list = []
+  for vh in vesselhandle_list:
+    if status_dict[vh] != explib.VESSEL_STATUS_STARTED:
+      stopped_vessel_list.append(vh)
+
+  # There's no log to fetch from a node that can't be reached, and trying
+  # would wait out a full timeout for each such vessel
+  unreachable_list = []
+  for vh in stopped_vessel_list:
+    if status_dict[vh] in (explib.VESSEL_STATUS_NODE_UNREACHABLE, explib.VESSEL_STATUS_NO_SUCH_NODE):
+      unreachable_list.append(vh)
+
+  if FETCH_VESSEL_LOGS:
+    log_vessel_logs(list_difference(vesselhandle_list, stopped_vessel_list), 'running')
+  log_vessel_logs(list_difference(stopped_vessel_list, unreachable_list), 'stopped')
+  if unreachable_list:
+    config['logfile'].write(str(time.time()) + ': Could not reach the nodes of ' + str(len(unreachable_list)) + ' stopped vessel(s)\n')
+    config['logfile'].flush()
+
+  return stopped_vessel_list
+
+
+
+def log_vessel_logs(vesselhandle_list, description):
+  """
+  Fetches the logs of a set of vessels and writes them to the log file,
+  describing each vessel as e.g. 'failed' or 'stopped'.
+  """
+  for vh in vesselhandle_list:
+    try:
+      vessel_log = explib.get_vessel_log(vh, config['identity'])
+    except:
+      vessel_log = '[ERROR: vessel log fetch failed]'
+
+    nodeid, vesselname = explib.get_nodeid_and_vesselname(vh)
+    try:
+      nodelocation = explib.get_node_location(nodeid)
+    except explib.SeattleExperimentError:
+      nodelocation = vh
+
+    # Log the vessel's log contents
+    config['logfile'].write('Log contents of ' + description + ' vessel at ' + nodelocation + ': ' + vessel_log + '\n')
+    config['logfile'].flush()
+
+
+
+def adopt_vessels():
+  """
+  <Purpose>
+    Sorts through the vessels acquired before this run of Overlord, for a
+    warm restart. Vessels that are running the current version of the program
+    (see upload_to_vessels) are kept as they are. Vessels whose node is up
+    but that have stopped, or are running an older version, are stopped if
+    need be so the program can be uploaded and started on them again. The
+    rest, and any beyond the number of vessels wanted, are released.
+
+  <Arguments>
+    None
+
+  <Exceptions>
+    None
+
+  <Side Effects>
+    Stops and releases vessels.
+
+  <Returns>
+    A tuple of:
+      (adopted_list, reusable_list)
+    where adopted_list is a list of vesselhandles of vessels that are running
+    the program, and reusable_list of vessels that are ready for it to be
+    uploaded and started.
+  """
+  vesselhandle_list = explib.seattlegeni_get_acquired_vessels(config['identity'])
+  if not vesselhandle_list:
+    return [], []
+
+  config['logfile'].write(str(time.time()) + ': Checking ' + str(len(vesselhandle_list)) + ' preallocated vessel(s) for a warm restart\n')
+  config['logfile'].flush()
+
+  try:
+    status_dict = explib.get_vessel_statuses(vesselhandle_list, config['identity'])
+  except explib.SeattleExperimentError, e:
+    config['logfile'].write('Vessel health check failed: ' + str(e) + '\n')
+    release_vessels(vesselhandle_list, 'Releasing ' + str(len(vesselhandle_list)) + ' preallocated vessels...')
+    return [], []
+
+  reachable_list = []
+  for vh in vesselhandle_list:
+    if status_dict[vh] in explib.VESSEL_STATUS_SET_ACTIVE:
+      reachable_list.append(vh)
+
+  checked_list, failed_list = explib.run_parallelized(reachable_list, _has_current_program,
+                                                      config['program_filename'],
+                                                      _file_hash(config['program_filename']),
+                                                      num_threads=UPLOAD_THREADS)
+
+  adopted_list = []
+  reusable_list = []
+  for vh, current in checked_list:
+    if current and status_dict[vh] == explib.VESSEL_STATUS_STARTED:
+      adopted_list.append(vh)
+    else:
+      reusable_list.append(vh)
+
+  # Keep no more vessels than we were asked for, preferring to reuse those
+  # that don't have to be stopped first
+  reusable_list.sort(key=lambda vh: status_dict[vh] == explib.VESSEL_STATUS_STARTED)
+  adopted_list = adopted_list[:config['vesselcount']]
+  reusable_list = reusable_list[:config['vesselcount'] - len(adopted_list)]
+
+  # Vessels still running an old version have to be stopped before it can be
+  # replaced
+  running_list = [vh for vh in reusable_list if status_dict[vh] == explib.VESSEL_STATUS_STARTED]
+  stopped_list, failed_list = explib.run_parallelized(running_list, explib.stop_vessel,
+                                                      config['identity'],
+                                                      num_threads=START_THREADS)
+  reusable_list = list_difference(reusable_list, [vh for vh, error in failed_list])
+
+  config['logfile'].write(str(time.time()) + ': Adopting ' + str(len(adopted_list)) + ' running vessel(s), reusing ' + str(len(reusable_list)) + '\n')
+  config['logfile'].flush()
+
+  unused_list = list_difference(vesselhandle_list, adopted_list + reusable_list)
+  release_vessels(unused_list, 'Releasing ' + str(len(unused_list)) + ' preallocated vessels that are broken or not needed...')
+
+  return adopted_list, reusable_list
+
+
+
 def reset_vessels():
   vesselhandle_list = explib.seattlegeni_get_acquired_vessels(config['identity'])
   release_vessels(vesselhandle_list, 'Releasing ' + str(len(vesselhandle_list)) + ' preallocated vessels...')
@@ -392,6 +706,121 @@ def get_vessels():
   print "Config: %s" % config
   return explib.seattlegeni_get_acquired_vessels(config['identity'])
 
+
+
+def get_active_vessels():
+  """
+  Returns a list of vesselhandles of the vessels the program is currently
+  running on. Unlike get_vessels(), this doesn't include vessels that have
+  been acquired but haven't started the program (yet).
+  """
+  _active_vessels_condition.acquire()
+  try:
+    return list(_active_vessels)
+  finally:
+    _active_vessels_condition.release()
+
+
+
+def wait_for_vessels(count, timeout=None):
+  """
+  <Purpose>
+    Waits until the program is running on at least count vessels.
+
+  <Arguments>
+    count
+      The number of running vessels to wait for.
+    timeout
+      (optional) The most seconds to wait. If None, waits for as long as it
+      takes.
+
+  <Exceptions>
+    None
+
+  <Side Effects>
+    None
+
+  <Returns>
+    True if count vessels are running, False if the timeout ran out first.
+  """
+  if timeout is not None:
+    deadline = time.time() + timeout
+
+  _active_vessels_condition.acquire()
+  try:
+    while len(_active_vessels) < count:
+      if timeout is None:
+        # Wake up now and then, so that KeyboardInterrupt gets through
+        _active_vessels_condition.wait(1)
+      else:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        _active_vessels_condition.wait(remaining)
+    return True
+  finally:
+    _active_vessels_condition.release()
+
+
+
+def add_vessel_listener(listener):
+  """
+  <Purpose>
+    Registers a function to be told whenever the set of vessels the program
+    is running on changes.
+
+  <Arguments>
+    listener
+      A function taking two arguments, (added_list, removed_list), the
+      vesselhandles of the vessels that have started running the program and
+      of those that have stopped or been released. It is called right away
+      with the vessels that are already running, and then from the thread
+      running run(), so it shouldn't block for long.
+
+  <Exceptions>
+    None
+
+  <Side Effects>
+    None
+
+  <Returns>
+    None
+  """
+  _active_vessels_condition.acquire()
+  try:
+    _vessel_listeners.append(listener)
+    current_list = list(_active_vessels)
+  finally:
+    _active_vessels_condition.release()
+
+  if current_list:
+    listener(current_list, [])
+
+
+
+def _set_active_vessels(vesselhandle_list):
+  """
+  Records vesselhandle_list as the vessels the program is running on, waking
+  wait_for_vessels() callers and telling listeners what changed.
+  """
+  _active_vessels_condition.acquire()
+  try:
+    added_list = list_difference(vesselhandle_list, _active_vessels)
+    removed_list = list_difference(_active_vessels, vesselhandle_list)
+    _active_vessels[:] = vesselhandle_list
+    listeners = list(_vessel_listeners)
+    _active_vessels_condition.notifyAll()
+  finally:
+    _active_vessels_condition.release()
+
+  if added_list or removed_list:
+    for listener in listeners:
+      try:
+        listener(added_list, removed_list)
+      except Exception, e:
+        config['logfile'].write(str(time.time()) + ': Vessel listener failed: ' + str(e) + '\n')
+        config['logfile'].flush()
+
 def get_config():
   return config
 
@@ -427,17 +856,38 @@ def run(*args):
   config['logfile'].flush()
 
   
-  # Release any preallocated vessels
-  vesselhandle_list = explib.seattlegeni_get_acquired_vessels(config['identity'])
-  release_vessels(vesselhandle_list, 'Releasing ' + str(len(vesselhandle_list)) + ' preallocated vessels...')
+  if config['warm_restart']:
+    # Keep whatever preallocated vessels are still good
+    adopted_list, vesselhandle_list = adopt_vessels()
+    # They may be well into their lease, and the main loop won't renew them
+    # until VESSEL_RENEWAL_PERIOD has passed, so renew them now
+    if adopted_list or vesselhandle_list:
+      try:
+        explib.seattlegeni_renew_vessels(config['identity'], adopted_list + vesselhandle_list)
+      except explib.SeattleGENIError, e:
+        config['logfile'].write('Failed to renew kept vessels: ' + str(e) + '\n')
+        config['logfile'].flush()
+  else:
+    # Release any preallocated vessels
+    vesselhandle_list = explib.seattlegeni_get_acquired_vessels(config['identity'])
+    release_vessels(vesselhandle_list, 'Releasing ' + str(len(vesselhandle_list)) + ' preallocated vessels...')
+    adopted_list = []
+    vesselhandle_list = []
 
   
-  # Acquire an initial sample of vessels
-  config['logfile'].write(str(time.time()) + ': Fetching initial batch of ' + str(config['vesselcount']) + ' vessels:\n')
-  config['logfile'].flush()
-  vesselhandle_list = []
-  while not vesselhandle_list:
-    vesselhandle_list = acquire_vessels(config['vesselcount'])
+  # Acquire an initial sample of vessels, or however many more are needed.
+  # Only keep trying if there's nothing to run on at all; the main loop
+  # makes up any shortfall.
+  needed = config['vesselcount'] - len(adopted_list) - len(vesselhandle_list)
+  if needed > 0:
+    config['logfile'].write(str(time.time()) + ': Fetching initial batch of ' + str(needed) + ' vessels:\n')
+    config['logfile'].flush()
+    fresh_vessels = []
+    while not fresh_vessels:
+      fresh_vessels = acquire_vessels(needed)
+      if adopted_list or vesselhandle_list:
+        break
+    vesselhandle_list.extend(fresh_vessels)
 
   # Upload program to vessels
   vesselhandle_list = upload_to_vessels(vesselhandle_list, config['program_filename'])
@@ -447,6 +897,7 @@ def run(*args):
   vesselhandle_list, failed_list = run_on_vessels(vesselhandle_list,
                                              config['program_filename'],
                                              *args)
+  vesselhandle_list.extend(adopted_list)
 
 
   # Release any failed vessels
@@ -454,22 +905,14 @@ def run(*args):
     config['logfile'].write(str(time.time()) + ': Running ' + config['program_filename'] + ' failed on ' + str(len(failed_list)) + ' vessels\n')
 
     # Get details about failed vessel(s) and log them
-    for vh in failed_list:
-      try:
-        vessel_log = explib.get_vessel_log(vh, config['identity'])
-      except:
-        vessel_log = '[ERROR: vessel log fetch failed]'
-        
-      nodeid, vesselname = explib.get_nodeid_and_vesselname(vh)
-      nodelocation = explib.get_node_location(nodeid)
-      
-      # Log the vessel's log contents
-      config['logfile'].write('Log contents of failed vessel at ' + nodelocation + ': ' + vessel_log + '\n')
-      config['logfile'].flush()
-      
+    log_vessel_logs(failed_list, 'failed')
+
     # Release the failed vessels
     release_vessels(failed_list, 'Releasing failed vessel(s)...')
 
+  # Let waiting clients know what's running
+  _set_active_vessels(vesselhandle_list)
+
 
 
   # Initialize counter variable for loop iterations
@@ -482,19 +925,7 @@ def run(*args):
   while KEEP_RUNNING == True:
     print "Starting Loop!"
     # Check for vessels not in started state
-    stopped_vessel_list = []
-    for vh in vesselhandle_list:
-      try:
-        vessel_status = explib.get_vessel_status(vh, config['identity'])
-        log = explib.get_vessel_log(vh, config['identity'])
-        print "Loop Log: %s" % log
-      except:
-        # Node lookup failed, so remove vessel from vesselhandle_list
-        # TODO: proper way to handle failed advertisements?
-        stopped_vessel_list.append(vh)
-      else:
-        if vessel_status != explib.VESSEL_STATUS_STARTED:
-          stopped_vessel_list.append(vh)
+    stopped_vessel_list = check_vessels(vesselhandle_list)
 
     # Release and replace any stopped vessels
     if stopped_vessel_list:
@@ -503,6 +934,7 @@ def run(*args):
 
       # Remove released vessels from vesselhandle_list
       vesselhandle_list = list_difference(vesselhandle_list, stopped_vessel_list)
+      _set_active_vessels(vesselhandle_list)
 
     # Ensure that enough vessels are running
     if len(vesselhandle_list) < config['vesselcount']:
@@ -522,18 +954,7 @@ def run(*args):
         config['logfile'].write(str(time.time()) + ': Running ' + config['program_filename'] + ' failed on ' + str(len(failed_list)) + ' vessels\n')
 
         # Get details about failed vessel(s) and log them
-        for vh in failed_list:
-          try:
-            vessel_log = explib.get_vessel_log(vh, config['identity'])
-          except:
-            vessel_log = '[ERROR: vessel log fetch failed]'
-
-          nodeid, vesselname = explib.get_nodeid_and_vesselname(vh)
-          nodelocation = explib.get_node_location(nodeid)
-
-          # Log the vessel's log contents
-          config['logfile'].write('Log contents of failed vessel at ' + nodelocation + ': ' + vessel_log + '\n')
-          config['logfile'].flush()
+        log_vessel_logs(failed_list, 'failed')
 
         # Release the failed vessels
         release_vessels(failed_list, 'Releasing failed vessel(s)...')
@@ -543,6 +964,7 @@ def run(*args):
 
       # Add fresh_vessels to vesselhandle_list
       vesselhandle_list.extend(fresh_vessels)
+      _set_active_vessels(vesselhandle_list)
 
 
     # Sleep for parameterized amount of time
@@ -0,0 +1,72 @@
+"""pagecache.py - A bounded, in-memory cache of the page bodies fetched for
+diff mode.
+
+Each entry holds the copy of a page loaded through a vessel and the copy loaded
+locally, and is identified by an ID derived from the url, the vessel, the user
+agent and the current time bucket. Diff pages refer to their entry by that ID,
+so concurrent diffs never see each other's pages, and a repeated diff of the
+same page from the same location within a bucket is answered from memory.
+
+Entries are evicted least-recently-used first once the cache holds more than
+its byte budget, and are dropped when they are older than the TTL.
+
+"""
+import collections
+import hashlib
+import threading
+import time
+
+
+class PageCache:
+
+  def __init__(self, maxBytes, ttl, bucketSeconds):
+    self.maxBytes = maxBytes
+    self.ttl = ttl
+    self.bucketSeconds = bucketSeconds
+    self.size = 0
+    self.entries = collections.OrderedDict() # id -> entry, least recently used first
+    self.lock = threading.Lock()
+
+  # The ID of the entry for this page, vessel and user agent in the current time bucket.
+  def makeId(self, url, vessel, agent):
+    bucket = int(time.time() / self.bucketSeconds)
+    return hashlib.sha1("%s\n%s\n%s\n%d" % (url, vessel, agent, bucket)).hexdigest()
+
+  # Returns the entry (a dict with 'proxy', 'local', 'complete' and 'stored' keys) or None if it isn't cached or has
+  # expired.
+  def get(self, entryId):
+    with self.lock:
+      entry = self.entries.pop(entryId, None)
+      if entry is None:
+        return None
+      if time.time() - entry['stored'] > self.ttl:
+        self.size -= entry['size']
+        return None
+      self.entries[entryId] = entry # Re-insert to mark it most recently used
+      return entry
+
+  # Store a pair of pages. complete is False when one of the two copies couldn't be loaded and holds an error page
+  # instead, which tells callers to try the fetch again rather than reuse the entry.
+  def put(self, entryId, proxyHtml, localHtml, complete=True):
+    entry = {'proxy' : proxyHtml, 'local' : localHtml, 'complete' : complete, 'stored' : time.time(), \
+      'size' : len(proxyHtml) + len(localHtml)}
+    with self.lock:
+      old = self.entries.pop(entryId, None)
+      if old is not None:
+        self.size -= old['size']
+      self.entries[entryId] = entry
+      self.size += entry['size']
+      self.evict()
+    return entry
+
+  # Drop expired entries, then least recently used ones until we're back under the byte budget. The newest entry is
+  # always kept, so the diff page that just stored it can load it. Call with the lock held.
+  def evict(self):
+    now = time.time()
+    for entryId, entry in self.entries.items():
+      if now - entry['stored'] > self.ttl:
+        del self.entries[entryId]
+        self.size -= entry['size']
+    while self.size > self.maxBytes and len(self.entries) > 1:
+      entryId, entry = self.entries.popitem(last=False)
+      self.size -= entry['size']
@@ -0,0 +1,74 @@
+"""staticfiles.py - The pages, scripts and stylesheets the UI is built from.
+
+Files are read once and kept in memory, along with a gzipped copy of those that
+compress, and read again only when their modification time or size changes.
+Each carries what the handler needs to let browsers cache it: a content type,
+an ETag and a Last-Modified date.
+
+Only files under a fixed set of directories of the root can be served. Paths
+that leave them, whether through '..' or a symbolic link, are refused.
+
+"""
+import cStringIO
+import email.utils
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+# Files smaller than this aren't worth compressing.
+MIN_GZIP_SIZE = 1024
+
+
+class StaticFiles:
+
+  def __init__(self, root, directories):
+    self.root = os.path.realpath(root)
+    self.directories = [os.path.join(self.root, directory) + os.sep for directory in directories]
+    self.files = {} # real path -> asset, see load()
+    self.lock = threading.Lock()
+
+  # Returns the asset for path, relative to the root, or None if there's no such file or it isn't one we serve. An
+  # asset is a dict with the keys 'body', 'gzip' (the gzipped body, or None), 'type', 'etag' and 'lastModified'.
+  def get(self, path):
+    fullPath = os.path.realpath(os.path.join(self.root, path.lstrip("/")))
+    if not [directory for directory in self.directories if fullPath.startswith(directory)]:
+      return None
+    try:
+      stat = os.stat(fullPath)
+    except OSError:
+      return None
+    if not os.path.isfile(fullPath):
+      return None
+
+    asset = self.files.get(fullPath)
+    if asset is not None and asset['mtime'] == stat.st_mtime and asset['size'] == stat.st_size:
+      return asset
+    with self.lock:
+      asset = self.load(fullPath, stat)
+      if asset is not None:
+        self.files[fullPath] = asset
+    return asset
+
+  def load(self, fullPath, stat):
+    try:
+      body = open(fullPath, 'rb').read()
+    except IOError:
+      return None
+    contentType = mimetypes.guess_type(fullPath)[0] or "application/octet-stream"
+    if contentType.startswith("text/") or contentType.endswith("javascript"):
+      contentType += "; charset=utf-8"
+
+    gzipped = None
+    if len(body) >= MIN_GZIP_SIZE:
+      buffer = cStringIO.StringIO()
+      gzipFile = gzip.GzipFile(fileobj=buffer, mode='wb', mtime=stat.st_mtime)
+      gzipFile.write(body)
+      gzipFile.close()
+      if buffer.tell() < len(body):
+        gzipped = buffer.getvalue()
+
+    return {'body' : body, 'gzip' : gzipped, 'type' : contentType, 'etag' : '"%s"' % hashlib.sha1(body).hexdigest(), \
+      'lastModified' : email.utils.formatdate(stat.st_mtime, usegmt=True), 'mtime' : stat.st_mtime, \
+      'size' : stat.st_size}
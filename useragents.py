@@ -0,0 +1,69 @@
+"""useragents.py - The catalogue of user agent strings in viewpoints.db.
+
+The os and useragents tables are small and change only when someone edits the
+database, so rather than query them on every request they're read into memory
+once and handed out from there. The database file's modification time is
+checked every so often, and the catalogue is read again when it has changed.
+
+"""
+import os
+import threading
+import time
+
+# How often, in seconds, to check whether the database has changed.
+CHECK_INTERVAL = 1
+
+
+class AgentCatalogue:
+
+  # conn is a connection to the database at dbPath, shared with other threads that serialize on connLock.
+  def __init__(self, conn, connLock, dbPath):
+    self.conn = conn
+    self.connLock = connLock
+    self.dbPath = dbPath
+    self.lock = threading.Lock() # Held while reloading, so only one thread does it
+    self.checked = 0
+    self.mtime = None
+    self.catalogue = None
+    with self.connLock:
+      self.conn.execute("CREATE INDEX IF NOT EXISTS useragents_os ON useragents(os)")
+      self.conn.commit()
+    self.refresh()
+
+  # The agent string of the user agent with the given rowid. Raises KeyError if there's no such user agent.
+  def agentString(self, agentId):
+    try:
+      agentId = int(agentId)
+    except ValueError:
+      raise KeyError(agentId)
+    return self.current()['agents'][agentId]
+
+  # The catalogue as it is now: a dict with the keys 'platforms', a list of (rowid, name) for each os, 'browsers', a
+  # dict of os rowid -> list of (rowid, description) for its user agents, and 'agents', a dict of rowid -> agent string.
+  # A reload replaces the dict rather than changing it, so a new one means the catalogue changed.
+  def current(self):
+    if time.time() - self.checked >= CHECK_INTERVAL:
+      self.refresh()
+    return self.catalogue
+
+  # Read the tables again if the database has changed since we last did. The new catalogue replaces the old one in a
+  # single assignment, so readers never see it half built.
+  def refresh(self):
+    with self.lock:
+      if time.time() - self.checked < CHECK_INTERVAL and self.catalogue is not None:
+        return
+      self.checked = time.time()
+      mtime = os.stat(self.dbPath).st_mtime
+      if mtime == self.mtime:
+        return
+
+      catalogue = {'platforms' : [], 'browsers' : {}, 'agents' : {}}
+      with self.connLock:
+        for rowId, name in self.conn.execute("SELECT rowid, name FROM os ORDER BY rowid"):
+          catalogue['platforms'].append((rowId, name))
+        for rowId, osId, description, agent in self.conn.execute( \
+            "SELECT rowid, os, description, agentstring FROM useragents ORDER BY rowid"):
+          catalogue['browsers'].setdefault(osId, []).append((rowId, description))
+          catalogue['agents'][rowId] = agent
+      self.catalogue = catalogue
+      self.mtime = mtime